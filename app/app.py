@@ -2,16 +2,11 @@ import os
 import sys
 import json
 import threading
+import warnings
 import time
-from flask import Flask, request, jsonify, render_template, send_file
+from flask import Flask, request, jsonify, render_template, send_file, Response, stream_with_context
 from PIL import Image
 from PIL.ExifTags import TAGS
-import torch
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from transformers import Blip2Processor, Blip2ForConditionalGeneration
-from transformers import VisionEncoderDecoderModel, ViTImageProcessor, AutoTokenizer
-import onnxruntime as ort
-import numpy as np
 import base64
 from io import BytesIO
 import uuid
@@ -30,6 +25,17 @@ load_dotenv()
 
 # Crear config.json automáticamente si no existe
 import shutil
+import re
+import hashlib
+import sqlite3
+import bisect
+import heapq
+import contextvars
+from functools import lru_cache
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from requests.adapters import HTTPAdapter
 if not os.path.exists('config.json'):
     if os.path.exists('config.example.json'):
         shutil.copy('config.example.json', 'config.json')
@@ -52,19 +58,39 @@ def load_config():
         print("⚠️ Archivo config.json no encontrado, usando configuración por defecto")
         return {
             "api_keys": {"openrouter": ""},
-            "settings": {"remote_model_max_image_size": 384, "image_quality": 85, "download_image_quality": 95},
+            "settings": {"remote_model_max_image_size": 384, "image_quality": 85, "download_image_quality": 95, "caption_batch_size": 4, "caption_candidates": 3, "remote_concurrency": 4, "deterministic_generation": False, "export_workers": 0},
             "server": {"port": 5000, "host": "localhost", "debug_mode": True},
             "limits": {"max_files": 100, "max_file_size_mb": 200},
-            "endpoints": {"openrouter_url": "https://openrouter.ai/api/v1/chat/completions"}
+            "endpoints": {"openrouter_url": "https://openrouter.ai/api/v1/chat/completions"},
+            "models": {"idle_ttl_seconds": 600, "memory_budget_mb": 0, "backends": {"blip": "pytorch", "blip2": "pytorch"}, "onnx_dir": "cache/onnx", "onnx_threads": 0, "precision": {"blip": "auto", "blip2": "auto"}, "snapshot_dir": "models", "offline": False, "preload": []},
+            "caption_cache": {"enabled": True, "path": "cache/captions.sqlite3", "max_size_mb": 50},
+            "tasks": {"ttl_seconds": 86400, "max_tasks": 100, "persist": True, "persist_dir": "tasks", "max_page_size": 500},
+            "derived_cache": {"enabled": True, "path": "cache/derived", "max_size_mb": 2048},
+            "caption_cleaning": {"extra_terms": []},
+            "encoder_cache": {"enabled": True, "max_size_mb": 256},
+            "scheduler": {"workers": 2, "interactive_workers": 1, "max_queued_jobs": 100, "affinity_max_wait_seconds": 120, "interactive_timeout_seconds": 300, "default_seconds_per_image": 2.0},
+            "pipeline": {"prefetch_images": 8, "workers": 2},
+            "metrics": {"enabled": True},
+            "tracing": {"enabled": True, "max_events": 5000, "profiler": False, "profile_dir": "profiles"}
         }
     except Exception as e:
         print(f"⚠️ Error cargando config.json: {e}, usando configuración por defecto")
         return {
             "api_keys": {"openrouter": ""},
-            "settings": {"remote_model_max_image_size": 384, "image_quality": 85, "download_image_quality": 95},
+            "settings": {"remote_model_max_image_size": 384, "image_quality": 85, "download_image_quality": 95, "caption_batch_size": 4, "caption_candidates": 3, "remote_concurrency": 4, "deterministic_generation": False, "export_workers": 0},
             "server": {"port": 5000, "host": "localhost", "debug_mode": True},
             "limits": {"max_files": 100, "max_file_size_mb": 200},
-            "endpoints": {"openrouter_url": "https://openrouter.ai/api/v1/chat/completions"}
+            "endpoints": {"openrouter_url": "https://openrouter.ai/api/v1/chat/completions"},
+            "models": {"idle_ttl_seconds": 600, "memory_budget_mb": 0, "backends": {"blip": "pytorch", "blip2": "pytorch"}, "onnx_dir": "cache/onnx", "onnx_threads": 0, "precision": {"blip": "auto", "blip2": "auto"}, "snapshot_dir": "models", "offline": False, "preload": []},
+            "caption_cache": {"enabled": True, "path": "cache/captions.sqlite3", "max_size_mb": 50},
+            "tasks": {"ttl_seconds": 86400, "max_tasks": 100, "persist": True, "persist_dir": "tasks", "max_page_size": 500},
+            "derived_cache": {"enabled": True, "path": "cache/derived", "max_size_mb": 2048},
+            "caption_cleaning": {"extra_terms": []},
+            "encoder_cache": {"enabled": True, "max_size_mb": 256},
+            "scheduler": {"workers": 2, "interactive_workers": 1, "max_queued_jobs": 100, "affinity_max_wait_seconds": 120, "interactive_timeout_seconds": 300, "default_seconds_per_image": 2.0},
+            "pipeline": {"prefetch_images": 8, "workers": 2},
+            "metrics": {"enabled": True},
+            "tracing": {"enabled": True, "max_events": 5000, "profiler": False, "profile_dir": "profiles"}
         }
 
 # Cargar configuración
@@ -77,6 +103,12 @@ if CONFIG["api_keys"]["openrouter"]:
 else:
     print("⚠️ No se encontró API key de OpenRouter en config.json")
 
+# Modo offline: transformers y huggingface_hub no contactan con el hub (se importan después, bajo demanda)
+if CONFIG.get("models", {}).get("offline", False):
+    os.environ['HF_HUB_OFFLINE'] = '1'
+    os.environ['TRANSFORMERS_OFFLINE'] = '1'
+    print("🔒 Modo offline: los modelos se cargan solo desde los snapshots locales")
+
 # Verificar si está en modo debug desde configuración
 DEBUG_MODE = CONFIG.get("server", {}).get("debug_mode", False)
 
@@ -111,6 +143,8 @@ def image_to_base64(image):
 
 def setup_cuda():
     """Configurar CUDA si está disponible"""
+    import torch
+    
     if torch.cuda.is_available():
         # Verificar si CUDA_VISIBLE_DEVICES está configurado
         cuda_visible = os.environ.get('CUDA_VISIBLE_DEVICES', '')
@@ -131,8 +165,16 @@ def setup_cuda():
         print("🔧 CUDA no disponible, usando CPU")
     return device
 
-# Configurar dispositivo
-device = setup_cuda()
+# Dispositivo de inferencia: torch, transformers y onnxruntime no se importan hasta que se
+# necesita un modelo local (arranque rápido para Llama Vision, metadatos y health checks)
+device = None
+
+def get_device():
+    """Dispositivo de inferencia (importa torch y detecta CUDA la primera vez)"""
+    global device
+    if device is None:
+        device = setup_cuda()
+    return device
 
 # Configuración de Flask
 app = Flask(__name__)
@@ -143,6 +185,148 @@ app.config['MAX_CONTENT_LENGTH'] = CONFIG["limits"]["max_file_size_mb"] * 1024 *
 os.makedirs('uploads', exist_ok=True)
 os.makedirs('static/captions', exist_ok=True)
 
+# Almacenamiento de subidas direccionado por contenido: uploads/objects/ab/cd/<sha256><ext>
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{64}(\.[a-z0-9]{1,10})?$')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def is_upload_id(file_ref):
+    """Comprobar si una referencia es un ID de contenido (hash SHA-256 + extensión)"""
+    return bool(UPLOAD_ID_PATTERN.match(file_ref or ''))
+
+def upload_object_path(file_id):
+    """Ruta del objeto de un ID de contenido, repartida en subdirectorios por los primeros bytes del hash"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'objects', file_id[:2], file_id[2:4], file_id)
+
+def resolve_upload_path(file_ref):
+    """Ruta en disco de un archivo subido a partir de su ID de contenido o de su nombre (subidas antiguas)"""
+    if is_upload_id(file_ref):
+        return upload_object_path(file_ref)
+    return os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file_ref or ''))
+
+# Índice en memoria de archivos subidos: búsqueda exacta O(1) y por prefijo con bisect sobre las claves ordenadas
+upload_index = None  # clave (ID de contenido o nombre de subida antigua) -> ruta
+upload_index_keys = []  # claves ordenadas para búsquedas por prefijo
+upload_index_lock = threading.Lock()
+
+def rebuild_upload_index():
+    """Reconstruir el índice recorriendo uploads/ (al arrancar o en el primer uso)"""
+    global upload_index, upload_index_keys
+    
+    upload_folder = app.config['UPLOAD_FOLDER']
+    index = {}
+    # Subidas antiguas: archivos sueltos en la raíz de uploads/
+    for entry in os.scandir(upload_folder):
+        if entry.is_file():
+            index[entry.name] = entry.path
+    # Objetos direccionados por contenido
+    for root, _, filenames in os.walk(os.path.join(upload_folder, 'objects')):
+        for filename in filenames:
+            if is_upload_id(filename):
+                index[filename] = os.path.join(root, filename)
+    
+    with upload_index_lock:
+        upload_index = index
+        upload_index_keys = sorted(index)
+    print(f"🗂️ Índice de archivos subidos: {len(index)} archivos")
+
+def ensure_upload_index():
+    """Construir el índice si todavía no existe"""
+    if upload_index is None:
+        rebuild_upload_index()
+
+def index_upload(key, file_path):
+    """Añadir un archivo al índice"""
+    ensure_upload_index()
+    with upload_index_lock:
+        if key not in upload_index:
+            bisect.insort(upload_index_keys, key)
+        upload_index[key] = file_path
+
+def unindex_upload(key):
+    """Quitar un archivo del índice"""
+    ensure_upload_index()
+    with upload_index_lock:
+        if upload_index.pop(key, None) is not None:
+            position = bisect.bisect_left(upload_index_keys, key)
+            if position < len(upload_index_keys) and upload_index_keys[position] == key:
+                del upload_index_keys[position]
+
+def lookup_upload(key):
+    """Ruta de un archivo subido por su clave exacta (O(1)); None si no existe"""
+    ensure_upload_index()
+    with upload_index_lock:
+        return upload_index.get(key)
+
+def find_uploads_by_prefix(prefix, limit=10):
+    """Claves que empiezan por un prefijo, en orden, usando bisect sobre las claves ordenadas"""
+    ensure_upload_index()
+    with upload_index_lock:
+        position = bisect.bisect_left(upload_index_keys, prefix)
+        matches = []
+        while position < len(upload_index_keys) and len(matches) < limit and upload_index_keys[position].startswith(prefix):
+            matches.append(upload_index_keys[position])
+            position += 1
+        return matches
+
+def spool_stream(stream, temp_dir, digest=None):
+    """Copiar un stream a un archivo temporal por trozos (memoria acotada), calculando el hash si se pide"""
+    fd, temp_path = tempfile.mkstemp(dir=temp_dir, suffix='.part')
+    size = 0
+    with os.fdopen(fd, 'wb') as out:
+        for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+            if digest is not None:
+                digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return temp_path, size
+
+def store_upload(file):
+    """Guardar un archivo subido por su hash SHA-256; devuelve (file_id, tamaño, ya_existía)"""
+    extension = os.path.splitext(secure_filename(file.filename))[1].lower()
+    temp_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+    stream = file.stream
+    digest = hashlib.sha256()
+    
+    if stream.seekable():
+        # Primera pasada solo de lectura: si el contenido ya existe no se escribe ningún byte
+        size = 0
+        for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+        file_id = f"{digest.hexdigest()}{extension}"
+        if os.path.exists(upload_object_path(file_id)):
+            index_upload(file_id, upload_object_path(file_id))
+            return file_id, size, True
+        stream.seek(0)
+        temp_path, _ = spool_stream(stream, temp_dir)
+    else:
+        # Stream no rebobinable: escribir a un temporal calculando el hash a la vez
+        temp_path, size = spool_stream(stream, temp_dir, digest)
+        file_id = f"{digest.hexdigest()}{extension}"
+        if os.path.exists(upload_object_path(file_id)):
+            os.remove(temp_path)
+            index_upload(file_id, upload_object_path(file_id))
+            return file_id, size, True
+    
+    # Publicar el objeto de forma atómica (dos subidas idénticas simultáneas escriben el mismo contenido)
+    object_path = upload_object_path(file_id)
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    os.replace(temp_path, object_path)
+    index_upload(file_id, object_path)
+    return file_id, size, False
+
+def normalize_file_entries(files):
+    """Aceptar IDs/nombres sueltos o dicts {'file_id', 'filename'} y devolver siempre dicts"""
+    entries = []
+    for entry in files:
+        if isinstance(entry, dict):
+            file_id = entry.get('file_id') or entry.get('filename', '')
+            entries.append({'file_id': file_id, 'filename': entry.get('filename') or file_id})
+        else:
+            entries.append({'file_id': entry, 'filename': entry})
+    return entries
+
 # Inicializar modelos globalmente
 models = {}
 processors = {}
@@ -176,10 +360,442 @@ def initialize_models():
     for model_name, status in model_loading_status.items():
         print(f"  - {model_name}: {'✅ Disponible' if status['available'] else '❌ No disponible'}")
     
-    print("💡 Los modelos se cargarán solo cuando los selecciones y se descargarán al finalizar")
+    print(f"💡 Los modelos se cargarán solo cuando los selecciones y se descargarán tras {get_models_config()['idle_ttl_seconds']:.0f}s de inactividad")
 
-# Variables globales para el progreso
+# Variables globales para el progreso (almacén de tareas acotado por TTL/LRU con persistencia opcional)
 progress_data = {}
+task_last_access = {}  # task_id -> último acceso, para la expulsión LRU
+task_store_lock = threading.RLock()
+task_update_condition = threading.Condition(task_store_lock)  # Despierta los streams SSE en cada cambio
+FINISHED_TASK_STATUSES = ('completed', 'error')
+TASK_PRUNE_INTERVAL_SECONDS = 60  # Frecuencia máxima del barrido de tareas expiradas en disco
+task_prune_last = 0.0
+
+def get_tasks_config():
+    """Obtener configuración del almacén de tareas desde config.json"""
+    tasks_config = CONFIG.get("tasks", {})
+    return {
+        'ttl_seconds': float(tasks_config.get("ttl_seconds", 86400)),
+        'max_tasks': int(tasks_config.get("max_tasks", 100)),
+        'persist': bool(tasks_config.get("persist", True)),
+        'persist_dir': tasks_config.get("persist_dir", "tasks"),
+        'max_page_size': int(tasks_config.get("max_page_size", 500))
+    }
+
+def task_file_path(task_id):
+    """Ruta del archivo JSON donde se persiste una tarea"""
+    return os.path.join(get_tasks_config()['persist_dir'], f"{secure_filename(task_id)}.json")
+
+def register_task(task_id, task):
+    """Registrar una tarea nueva y expulsar las tareas terminadas que sobren"""
+    task.setdefault('created_at', time.time())
+    with task_store_lock:
+        progress_data[task_id] = task
+        task_last_access[task_id] = time.time()
+        evict_tasks()
+
+def get_task(task_id):
+    """Obtener una tarea, recuperándola del disco si fue expulsada de memoria o el servidor se reinició"""
+    with task_store_lock:
+        task = progress_data.get(task_id)
+        if task is None:
+            task = load_persisted_task(task_id)
+            if task is None:
+                return None
+            progress_data[task_id] = task
+        task_last_access[task_id] = time.time()
+        return task
+
+def notify_task_update(task_id):
+    """Avisar a los streams SSE de que una tarea ha cambiado (modelo, resultado, fin o error)"""
+    with task_update_condition:
+        task_update_condition.notify_all()
+
+def finish_task(task_id):
+    """Marcar una tarea como terminada (completed/error) y persistirla en disco"""
+    tasks_config = get_tasks_config()
+    with task_store_lock:
+        task = progress_data.get(task_id)
+        if task is None:
+            return
+        task['finished_at'] = time.time()
+        task_last_access[task_id] = time.time()
+        
+        if tasks_config['persist']:
+            try:
+                os.makedirs(tasks_config['persist_dir'], exist_ok=True)
+                file_path = task_file_path(task_id)
+                with open(f"{file_path}.tmp", 'w', encoding='utf-8') as f:
+                    json.dump(task, f, ensure_ascii=False)
+                os.replace(f"{file_path}.tmp", file_path)
+            except Exception as e:
+                print(f"⚠️ No se pudo persistir la tarea {task_id}: {e}")
+    
+    notify_task_update(task_id)
+
+def load_persisted_task(task_id):
+    """Cargar una tarea persistida; None si no existe o ya expiró"""
+    tasks_config = get_tasks_config()
+    file_path = task_file_path(task_id)
+    if not tasks_config['persist'] or not os.path.exists(file_path):
+        return None
+    
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            task = json.load(f)
+    except Exception as e:
+        print(f"⚠️ No se pudo leer la tarea persistida {task_id}: {e}")
+        return None
+    
+    if time.time() - task.get('finished_at', 0) > tasks_config['ttl_seconds']:
+        os.remove(file_path)
+        return None
+    return task
+
+def prune_persisted_tasks(force=False):
+    """Borrar del disco las tareas persistidas cuyo TTL ha expirado, estén o no en memoria
+
+    Cubre las tareas expulsadas de memoria por LRU y los archivos de ejecuciones anteriores.
+    Un archivo solo se escribe al terminar la tarea, así que su fecha de modificación no es
+    anterior a finished_at: basta con ella y no hace falta leer el JSON.
+    """
+    global task_prune_last
+    
+    tasks_config = get_tasks_config()
+    now = time.time()
+    if not tasks_config['persist'] or (not force and now - task_prune_last < TASK_PRUNE_INTERVAL_SECONDS):
+        return 0
+    task_prune_last = now
+    
+    removed = 0
+    try:
+        entries = list(os.scandir(tasks_config['persist_dir']))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        # También los temporales que dejó una escritura interrumpida
+        if not entry.name.endswith(('.json', '.json.tmp')) or not entry.is_file():
+            continue
+        try:
+            if now - entry.stat().st_mtime > tasks_config['ttl_seconds']:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            pass  # Borrado a la vez por otro hilo
+    if removed:
+        print(f"🧹 {removed} tareas expiradas eliminadas de {tasks_config['persist_dir']}")
+    return removed
+
+def evict_tasks():
+    """Expulsar tareas terminadas: por TTL (memoria y disco) y por LRU si se supera max_tasks (solo memoria)"""
+    tasks_config = get_tasks_config()
+    now = time.time()
+    with task_store_lock:
+        # Las tareas en curso nunca se expulsan: su hilo sigue escribiendo en ellas
+        finished = [task_id for task_id, task in progress_data.items() if task.get('status') in FINISHED_TASK_STATUSES]
+        
+        for task_id in finished:
+            if now - progress_data[task_id].get('finished_at', now) > tasks_config['ttl_seconds']:
+                del progress_data[task_id]
+                task_last_access.pop(task_id, None)
+                if tasks_config['persist'] and os.path.exists(task_file_path(task_id)):
+                    os.remove(task_file_path(task_id))
+        
+        finished = sorted((task_last_access.get(task_id, 0), task_id) for task_id in finished if task_id in progress_data)
+        for _, task_id in finished[:max(0, len(finished) - tasks_config['max_tasks'])]:
+            # Sigue disponible en disco hasta que expire su TTL
+            del progress_data[task_id]
+            task_last_access.pop(task_id, None)
+    
+    # Las tareas que ya no están en memoria solo se borran del disco con el barrido
+    prune_persisted_tasks()
+
+# Métricas Prometheus en memoria (formato de texto de exposición, sin dependencias adicionales).
+# Registrar un valor cuesta un lock y una operación de diccionario: se puede dejar activo en el bucle de procesamiento
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)  # Segundos
+METRICS_HELP = {
+    'captioning_images_total': ('counter', 'Imágenes procesadas por modelo y resultado'),
+    'captioning_stage_seconds': ('histogram', 'Duración de cada etapa del captioning (decode, preprocess, generate, cleanup, postprocess, remote_api)'),
+    'captioning_model_loads_total': ('counter', 'Cargas de modelos locales por resultado'),
+    'captioning_model_load_seconds': ('histogram', 'Duración de la carga de un modelo local'),
+    'captioning_model_unloads_total': ('counter', 'Descargas de modelos locales de memoria'),
+    'captioning_model_unload_seconds': ('histogram', 'Duración de la descarga de un modelo local'),
+    'captioning_openrouter_responses_total': ('counter', 'Respuestas de OpenRouter por código HTTP (error = sin respuesta)'),
+    'captioning_zip_export_bytes_total': ('counter', 'Bytes enviados en exportaciones ZIP'),
+    'captioning_zip_export_seconds': ('histogram', 'Duración de una exportación ZIP completa'),
+    'captioning_queue_depth': ('gauge', 'Trabajos en espera en el planificador'),
+    'captioning_running_jobs': ('gauge', 'Trabajos en ejecución en el planificador'),
+    'captioning_tasks': ('gauge', 'Tareas en memoria (progress_data) por estado'),
+    'captioning_model_loaded': ('gauge', 'Modelos locales cargados en memoria (1 = cargado)'),
+    'captioning_model_leases': ('gauge', 'Leases activos por modelo local'),
+    'captioning_caption_cache_events_total': ('counter', 'Eventos de la caché de captions'),
+    'captioning_encoder_cache_events_total': ('counter', 'Eventos de la caché del codificador de visión'),
+}
+metrics_values = {}  # (nombre, etiquetas ordenadas) -> valor del contador, o [cuentas por bucket, suma, total]
+metrics_lock = threading.Lock()
+
+def is_metrics_enabled():
+    """Comprobar si las métricas están activadas en config.json"""
+    return bool(CONFIG.get("metrics", {}).get("enabled", True))
+
+def metrics_inc(name, amount=1, **labels):
+    """Incrementar un contador"""
+    if not is_metrics_enabled():
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics_values[key] = metrics_values.get(key, 0) + amount
+
+def metrics_observe(name, seconds, **labels):
+    """Registrar una duración en un histograma (las cuentas por bucket se acumulan al exportar)"""
+    if not is_metrics_enabled():
+        return
+    key = (name, tuple(sorted(labels.items())))
+    bucket = bisect.bisect_left(METRICS_BUCKETS, seconds)
+    with metrics_lock:
+        histogram = metrics_values.get(key)
+        if histogram is None:
+            histogram = metrics_values[key] = [[0] * (len(METRICS_BUCKETS) + 1), 0.0, 0]
+        histogram[0][bucket] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+@contextmanager
+def metrics_timer(name, **labels):
+    """Medir la duración de un bloque en un histograma: with metrics_timer('captioning_stage_seconds', ...)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics_observe(name, time.perf_counter() - start, **labels)
+
+def collect_metrics_gauges():
+    """Valores instantáneos que se leen al exportar (no cuestan nada en el bucle de procesamiento)"""
+    samples = []
+    with job_scheduler_condition:
+        samples.append(('captioning_queue_depth', (), len(job_queue)))
+        samples.append(('captioning_running_jobs', (), len(running_jobs)))
+    with task_store_lock:
+        statuses = [task.get('status', 'unknown') for task in progress_data.values()]
+    for status in sorted(set(statuses)):
+        samples.append(('captioning_tasks', (('status', status),), statuses.count(status)))
+    with model_registry_lock:
+        for model_name, entry in sorted(model_registry.items()):
+            samples.append(('captioning_model_loaded', (('model', model_name),), int(entry['loaded'])))
+            samples.append(('captioning_model_leases', (('model', model_name),), entry['refs']))
+    # Los contadores de las cachés ya existen: se exportan tal cual
+    for event, value in caption_cache_counters.items():
+        samples.append(('captioning_caption_cache_events_total', (('event', event),), value))
+    for event, value in encoder_cache_counters.items():
+        samples.append(('captioning_encoder_cache_events_total', (('event', event),), value))
+    return samples
+
+def format_metric_labels(labels):
+    """Etiquetas en formato Prometheus: {clave="valor",...}"""
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+def render_metrics():
+    """Exportar todas las métricas en el formato de texto de Prometheus"""
+    with metrics_lock:
+        snapshot = [(name, labels, [list(value[0]), value[1], value[2]] if isinstance(value, list) else value)
+                    for (name, labels), value in metrics_values.items()]
+    snapshot += collect_metrics_gauges()
+    
+    lines = []
+    for metric in sorted(METRICS_HELP):
+        samples = sorted((labels, value) for name, labels, value in snapshot if name == metric)
+        if not samples:
+            continue
+        metric_type, help_text = METRICS_HELP[metric]
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for labels, value in samples:
+            if metric_type != 'histogram':
+                lines.append(f"{metric}{format_metric_labels(labels)} {value}")
+                continue
+            counts, total_seconds, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(METRICS_BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{metric}_bucket{format_metric_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{metric}_sum{format_metric_labels(labels)} {total_seconds}")
+            lines.append(f"{metric}_count{format_metric_labels(labels)} {count}")
+    return '\n'.join(lines) + '\n'
+
+# Trazas por tarea: cada etapa medida se registra también en la traza activa. Es un contextvar,
+# por lo que se propaga a los hilos de precarga y de la API remota al enviar con copy_context().run
+current_trace = contextvars.ContextVar('current_trace', default=None)
+# Posición en la tarea de la imagen que procesa el hilo actual (rutas de una sola imagen, p. ej. la API remota)
+current_trace_image = contextvars.ContextVar('current_trace_image', default=None)
+task_profiler_lock = threading.Lock()  # Solo un perfil de torch a la vez (el profiler es global al proceso)
+
+def get_tracing_config():
+    """Obtener configuración de las trazas por tarea y del profiler desde config.json"""
+    tracing_config = CONFIG.get("tracing", {})
+    return {
+        'enabled': bool(tracing_config.get("enabled", True)),
+        'max_events': max(0, int(tracing_config.get("max_events", 5000))),
+        # El profiler de torch solo se puede pedir por tarea si está permitido aquí
+        'profiler': bool(tracing_config.get("profiler", False)),
+        'profile_dir': tracing_config.get("profile_dir", "profiles")
+    }
+
+def new_trace(filenames=()):
+    """Traza vacía para las imágenes de una tarea (nombres en su orden); None si las trazas están desactivadas
+
+    Los eventos identifican cada imagen por su posición en la tarea: una misma imagen subida
+    dos veces tiene el mismo ID de contenido pero dos entradas distintas en la traza.
+    """
+    if not get_tracing_config()['enabled']:
+        return None
+    return {'started_at': time.time(), 'images': list(filenames), 'events': [], 'dropped': 0}
+
+def trace_event(stage, model_name, started_at, seconds, images=()):
+    """Añadir un evento (etapa, inicio relativo, duración, posiciones de las imágenes) a la traza activa"""
+    trace = current_trace.get()
+    if trace is None:
+        return
+    if len(trace['events']) >= get_tracing_config()['max_events']:
+        trace['dropped'] += 1
+        return
+    trace['events'].append({
+        'stage': stage,
+        'model': model_name,
+        'start_ms': round((started_at - trace['started_at']) * 1000, 3),
+        'duration_ms': round(seconds * 1000, 3),
+        'images': list(images)
+    })
+
+def observe_stage(model_name, stage, started_at, seconds, images=()):
+    """Registrar una etapa ya medida en el histograma de Prometheus y en la traza activa"""
+    metrics_observe('captioning_stage_seconds', seconds, model=model_name, stage=stage)
+    trace_event(stage, model_name, started_at, seconds, images)
+
+@contextmanager
+def stage_timer(model_name, stage, images=None):
+    """Medir una etapa del captioning: with stage_timer('blip', 'decode', [posición])
+
+    Sin images, la etapa se atribuye a la imagen del hilo actual (current_trace_image), si la hay.
+    """
+    trace = current_trace.get()
+    if images is None:
+        index = current_trace_image.get()
+        images = [] if index is None else [index]
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        if trace is not None and trace.get('profiling'):
+            # Con el profiler activo la etapa aparece como bloque con nombre en el perfil de torch
+            import torch
+            with torch.profiler.record_function(stage):
+                yield
+        else:
+            yield
+    finally:
+        observe_stage(model_name, stage, started_at, time.perf_counter() - start, images)
+
+def run_traced(trace, fn, *args):
+    """Ejecutar fn con la traza activa (en un worker del planificador); registra la espera en cola"""
+    token = current_trace.set(trace)
+    try:
+        if trace is not None:
+            trace_event('queue', None, trace['started_at'], time.time() - trace['started_at'])
+        return fn(*args)
+    finally:
+        current_trace.reset(token)
+
+def run_for_image(index, fn, *args):
+    """Ejecutar fn atribuyendo sus etapas a la imagen index de la tarea"""
+    token = current_trace_image.set(index)
+    try:
+        return fn(*args)
+    finally:
+        current_trace_image.reset(token)
+
+def summarize_trace(trace):
+    """Resumen de una traza: duración total, tiempo por etapa e imágenes más lentas
+
+    El tiempo de las etapas por lotes se reparte a partes iguales entre las imágenes del lote.
+    La etapa 'cleanup' está anidada dentro de 'generate'.
+    """
+    names = trace.get('images', [])
+    stages = {}
+    per_image = {}
+    wall_ms = 0.0
+    for event in trace['events']:
+        stage = stages.setdefault(event['stage'], {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stage['count'] += 1
+        stage['total_ms'] += event['duration_ms']
+        stage['max_ms'] = max(stage['max_ms'], event['duration_ms'])
+        wall_ms = max(wall_ms, event['start_ms'] + event['duration_ms'])
+        for image in event['images']:
+            per_image[image] = per_image.get(image, 0.0) + event['duration_ms'] / len(event['images'])
+    for stage in stages.values():
+        stage['total_ms'] = round(stage['total_ms'], 3)
+    slowest = sorted(per_image.items(), key=lambda item: -item[1])[:5]
+    return {
+        'wall_ms': round(wall_ms, 3),
+        'stages': stages,
+        'slowest_images': [{'index': index, 'image': names[index] if index < len(names) else None, 'ms': round(ms, 3)}
+                           for index, ms in slowest],
+        'events': len(trace['events']),
+        'dropped': trace['dropped']
+    }
+
+def server_timing_header(trace):
+    """Cabecera Server-Timing con el tiempo total de cada etapa de una traza"""
+    stages = summarize_trace(trace)['stages']
+    return ', '.join(f"{stage};dur={values['total_ms']:.1f}" for stage, values in stages.items())
+
+def start_task_profiler(task_id):
+    """Arrancar el profiler de torch para una tarea; None si ya hay otro perfil en curso"""
+    if not task_profiler_lock.acquire(blocking=False):
+        progress_data[task_id]['profile'] = {'error': 'Ya hay otro perfil en curso'}
+        return None
+    try:
+        import torch
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if get_device().type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        profiler.start()
+    except Exception as e:
+        task_profiler_lock.release()
+        progress_data[task_id]['profile'] = {'error': str(e)}
+        return None
+    
+    trace = current_trace.get()
+    if trace is not None:
+        trace['profiling'] = True
+    print(f"🔬 Profiler de torch activo para la tarea {task_id}")
+    return profiler
+
+def save_task_profiler(task_id, profiler):
+    """Detener el profiler y guardar la traza (formato Chrome, abrir con chrome://tracing o Perfetto)"""
+    if profiler is None:
+        return
+    trace = current_trace.get()
+    if trace is not None:
+        trace.pop('profiling', None)
+    try:
+        profiler.stop()
+        profile_dir = get_tracing_config()['profile_dir']
+        os.makedirs(profile_dir, exist_ok=True)
+        file_path = os.path.join(profile_dir, f"{task_id}.json")
+        profiler.export_chrome_trace(file_path)
+        progress_data[task_id]['profile'] = {'path': file_path, 'size_mb': round(os.path.getsize(file_path) / 1024**2, 2)}
+        print(f"🔬 Perfil de la tarea {task_id} guardado en {file_path}")
+    except Exception as e:
+        progress_data[task_id]['profile'] = {'error': str(e)}
+        print(f"⚠️ No se pudo guardar el perfil de la tarea {task_id}: {e}")
+    finally:
+        task_profiler_lock.release()
 
 @app.route('/')
 def index():
@@ -187,8 +803,25 @@ def index():
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    """Servir archivos subidos"""
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    """Servir archivos subidos (por ID de contenido o por nombre)"""
+    file_path = lookup_upload(filename)
+    if not file_path:
+        return jsonify({'error': 'Imagen no encontrada'}), 404
+    return send_file(file_path)
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    """Health check del contenedor (no importa torch ni carga modelos); 503 mientras se precargan modelos"""
+    if not model_preload_state['ready']:
+        return jsonify({'status': 'starting', 'preloading': model_preload_state['pending']}), 503
+    return jsonify({'status': 'ok', 'ml_loaded': device is not None, 'preload_failed': model_preload_state['failed']})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas en formato Prometheus (metrics.enabled en config.json)"""
+    if not is_metrics_enabled():
+        return jsonify({'error': 'Métricas desactivadas'}), 404
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/api/models', methods=['GET'])
 def get_models():
@@ -231,8 +864,13 @@ def get_models_status():
         status = {
             'current_loaded': current_loaded_model,
             'loading_system': 'dynamic',
-            'device': str(device),
-            'cuda_available': torch.cuda.is_available(),
+            # Sin modelos locales usados todavía no se ha importado torch: no se fuerza aquí
+            'device': str(device) if device is not None else None,
+            'cuda_available': device.type == 'cuda' if device is not None else None,
+            'registry': get_model_registry_status(),
+            'encoder_cache': get_encoder_cache_stats(),
+            'scheduler': get_scheduler_status(),
+            'preload': model_preload_state,
             'models': {}
         }
         
@@ -250,7 +888,9 @@ def get_models_status():
                 status['models'][model_name] = {
                     'loaded': model_name in models and models[model_name] is not None,
                     'available': model_loading_status.get(model_name, {}).get('available', True),
-                    'in_memory': model_name in models
+                    'in_memory': model_name in models,
+                    'backend': get_model_backend(model_name),
+                    'precision': get_model_precision(model_name) if device is not None else None
                 }
         
         # Estado de modelos WD14 eliminado
@@ -259,6 +899,23 @@ def get_models_status():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Obtener estadísticas de la caché de captions"""
+    try:
+        return jsonify(get_caption_cache_stats())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/cache/clear', methods=['POST'])
+def clear_cache():
+    """Vaciar la caché de captions"""
+    try:
+        clear_caption_cache()
+        return jsonify({'success': True, 'message': 'Caché de captions vaciada'})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/upload', methods=['POST'])
 def upload_files():
     """Subir archivos para procesamiento"""
@@ -274,30 +931,32 @@ def upload_files():
         if len(files) > CONFIG["limits"]["max_files"]:
             return jsonify({'error': f'Máximo {CONFIG["limits"]["max_files"]} archivos permitidos'}), 400
         
-        # Verificar tamaño total
-        total_size = 0
-        for file in files:
-            file.seek(0, 2)  # Ir al final del archivo
-            file_size = file.tell()
-            file.seek(0)  # Volver al inicio
-            total_size += file_size
-        
+        # Verificar tamaño total (longitud de la petición, sin recorrer los archivos)
         max_total_size = CONFIG["limits"]["max_files"] * CONFIG["limits"]["max_file_size_mb"] * 1024 * 1024
-        if total_size > max_total_size:
+        if (request.content_length or 0) > max_total_size:
             return jsonify({'error': f'Tamaño total excede {CONFIG["limits"]["max_files"] * CONFIG["limits"]["max_file_size_mb"]}MB'}), 413
         
-        # Procesar archivos
-        uploaded_files = []
+        # Procesar archivos: hash en streaming y almacenamiento direccionado por contenido
+        uploads = []
         for file in files:
             if file and file.filename:
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
-                uploaded_files.append(filename)
+                file_id, size, duplicate = store_upload(file)
+                uploads.append({
+                    'file_id': file_id,
+                    'filename': secure_filename(file.filename),
+                    'size': size,
+                    'duplicate': duplicate
+                })
+        
+        duplicates = sum(1 for upload in uploads if upload['duplicate'])
+        if duplicates:
+            print(f"♻️ {duplicates} de {len(uploads)} archivos ya existían, no se han vuelto a escribir")
         
         return jsonify({
-            'message': f'{len(uploaded_files)} archivos subidos exitosamente',
-            'files': uploaded_files
+            'message': f'{len(uploads)} archivos subidos exitosamente',
+            'files': [upload['file_id'] for upload in uploads],
+            'uploads': uploads,
+            'duplicates': duplicates
         })
         
     except Exception as e:
@@ -309,28 +968,41 @@ def generate_captions():
     try:
         data = request.get_json()
         model_name = data.get('model', 'blip')
-        files = data.get('files', [])
+        files = normalize_file_entries(data.get('files', []))
         keyword = data.get('keyword', '')
         min_words = data.get('min_words', 0)
         consistency_mode = data.get('consistency_mode', 'auto')
         custom_prompt = data.get('custom_prompt', '')
+        profile = bool(data.get('profile', False))
         
         if not files:
             return jsonify({'error': 'No se especificaron archivos'}), 400
+        if profile and not get_tracing_config()['profiler']:
+            return jsonify({'error': 'El profiler está desactivado (tracing.profiler en config.json)'}), 400
         
         # Iniciar procesamiento asíncrono
         task_id = str(uuid.uuid4())
-        progress_data[task_id] = {
-            'status': 'processing',
+        trace = new_trace([entry['filename'] for entry in files])
+        task = {
+            'status': 'queued',
             'progress': 0,
             'total': len(files),
             'current': 0,
             'results': []
         }
-        
-        # Procesar en hilo separado
-        thread = threading.Thread(target=process_images_async, args=(files, model_name, task_id, keyword, min_words, consistency_mode, custom_prompt))
-        thread.start()
+        if trace is not None:
+            task['trace'] = trace
+        register_task(task_id, task)
+        
+        # Encolar en el planificador (pool acotado de workers, agrupado por modelo)
+        future = submit_job(run_traced, (trace, process_images_async, files, model_name, task_id, keyword, min_words, consistency_mode, custom_prompt, profile),
+                            model_name=model_name, images=len(files), priority=JOB_PRIORITY_BATCH, task_id=task_id,
+                            file_ids=[entry['file_id'] for entry in files])
+        if future is None:
+            progress_data[task_id]['status'] = 'error'
+            progress_data[task_id]['error'] = 'Cola de trabajos llena'
+            finish_task(task_id)
+            return jsonify({'error': 'Servidor ocupado: cola de trabajos llena, inténtalo más tarde'}), 503
         
         return jsonify({'task_id': task_id})
         
@@ -348,12 +1020,13 @@ def regenerate_single_caption():
         consistency_mode = data.get('consistency_mode', 'auto')
         custom_prompt = data.get('custom_prompt', '')
         filename = data.get('filename', '')
+        file_id = data.get('file_id') or filename
         
-        if not filename:
+        if not file_id:
             return jsonify({'error': 'No se especificó imagen para regenerar'}), 400
         
         # Verificar que la imagen existe
-        image_path = os.path.join('uploads', filename)
+        image_path = resolve_upload_path(file_id)
         if not os.path.exists(image_path):
             return jsonify({'error': f'Imagen no encontrada: {filename}'}), 404
         
@@ -361,21 +1034,29 @@ def regenerate_single_caption():
         print(f"📋 Parámetros recibidos: consistency_mode='{consistency_mode}', keyword='{keyword}', min_words={min_words}")
         print(f"🎲 Usando parámetros de aleatoriedad para generar caption diferente")
         
-        # Generar nuevo caption
-        new_caption = generate_caption(
-            image_path=image_path,
-            model_name=model_name,
-            keyword=keyword,
-            min_words=min_words,
-            consistency_mode=consistency_mode,
-            custom_prompt=custom_prompt
-        )
+        # Generar nuevo caption en el carril prioritario del planificador
+        # (refresh_cache=True: siempre generar uno nuevo; la caché guarda el último)
+        trace = new_trace([filename or file_id])
+        future = submit_job(run_traced, (trace, generate_caption, image_path, model_name, keyword, min_words, consistency_mode, custom_prompt, True),
+                            model_name=model_name, images=1, priority=JOB_PRIORITY_INTERACTIVE, file_ids=[file_id])
+        if future is None:
+            return jsonify({'error': 'Servidor ocupado: cola de trabajos llena, inténtalo más tarde'}), 503
+        try:
+            new_caption = future.result(timeout=get_scheduler_config()['interactive_timeout_seconds'])
+        except TimeoutError:
+            cancel_job(future)
+            return jsonify({'error': 'Tiempo de espera agotado en la cola de trabajos'}), 503
+        metrics_inc('captioning_images_total', model=model_name, result='error' if is_error_caption(new_caption) else 'ok')
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'caption': new_caption,
             'model_used': model_name
         })
+        # Tiempo por etapa visible en las herramientas de desarrollo del navegador
+        if trace is not None:
+            response.headers['Server-Timing'] = server_timing_header(trace)
+        return response
         
     except Exception as e:
         print(f"Error en regenerate_single_caption: {e}")
@@ -646,76 +1327,498 @@ def analyze_metadata():
 
 @app.route('/api/progress/<task_id>', methods=['GET'])
 def get_progress(task_id):
-    """Obtener progreso del procesamiento"""
-    if task_id not in progress_data:
+    """Obtener progreso del procesamiento
+    
+    ?since=N devuelve solo los resultados a partir del cursor N (polling incremental);
+    ?offset=N&limit=M pagina la lista de resultados. Sin parámetros se devuelven todos.
+    'timing' resume la traza de etapas; ?trace=1 incluye además todos sus eventos.
+    """
+    task = get_task(task_id)
+    if task is None:
+        return jsonify({'error': 'Tarea no encontrada'}), 404
+    
+    results = task['results']
+    results_total = len(results)
+    since = request.args.get('since', type=int)
+    offset = since if since is not None else request.args.get('offset', 0, type=int)
+    offset = min(max(offset, 0), results_total)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = min(max(limit, 0), get_tasks_config()['max_page_size'])
+    end = results_total if limit is None else min(results_total, offset + limit)
+    
+    # Copia superficial sin la lista completa: el coste no crece con los resultados ya entregados
+    response = {key: value for key, value in task.items() if key not in ('results', 'trace')}
+    trace = task.get('trace')
+    if trace is not None:
+        response['timing'] = summarize_trace(trace)
+        if request.args.get('trace', type=int):
+            response['trace'] = trace
+    response['results'] = results[offset:end]
+    response['results_total'] = results_total
+    response['cursor'] = end
+    return jsonify(response)
+
+# Server-Sent Events: el id de cada evento 'result' es el cursor de resultados (reanudable con Last-Event-ID)
+SSE_KEEPALIVE_SECONDS = 15
+TASK_STATE_KEYS = ('status', 'message', 'progress', 'current', 'total', 'error', 'queue_position', 'estimated_start', 'estimated_wait_seconds', 'prefetch')
+
+def sse_event(event, data, event_id=None):
+    """Formatear un evento SSE"""
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return '\n'.join(lines) + '\n\n'
+
+def iter_task_events(task_id, cursor=0):
+    """Generar eventos SSE de una tarea: model_loading, progress, result, completed y task_error"""
+    last_state = None
+    while True:
+        timed_out = False
+        with task_update_condition:
+            task = get_task(task_id)
+            if task is None:
+                yield sse_event('task_error', {'status': 'error', 'error': 'Tarea no encontrada'})
+                return
+            
+            new_results = task['results'][cursor:]
+            state = {key: task.get(key) for key in TASK_STATE_KEYS}
+            changed = bool(new_results) or state != last_state
+            if not changed:
+                timed_out = not task_update_condition.wait(timeout=SSE_KEEPALIVE_SECONDS)
+        
+        if not changed:
+            # Comentario SSE para mantener viva la conexión a través de proxies
+            if timed_out:
+                yield ': keep-alive\n\n'
+            continue
+        
+        for result in new_results:
+            cursor += 1
+            yield sse_event('result', {'index': cursor - 1, 'result': result, 'total': state['total']}, event_id=cursor)
+        
+        if state != last_state:
+            if state['status'] == 'downloading_model':
+                event = 'model_loading'
+            elif state['status'] == 'completed':
+                event = 'completed'
+            elif state['status'] == 'error':
+                event = 'task_error'
+            else:
+                event = 'progress'
+            yield sse_event(event, {**state, 'results_total': cursor})
+            last_state = state
+        
+        if state['status'] in FINISHED_TASK_STATUSES:
+            return
+
+@app.route('/api/progress/<task_id>/stream', methods=['GET'])
+def stream_progress(task_id):
+    """Stream SSE con el progreso y los resultados de una tarea según se producen"""
+    if get_task(task_id) is None:
         return jsonify({'error': 'Tarea no encontrada'}), 404
     
-    return jsonify(progress_data[task_id])
+    # Reconexión: el navegador envía el último id recibido (= número de resultados ya entregados)
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('since', '0')
+    cursor = int(last_event_id) if last_event_id.isdigit() else 0
+    
+    return Response(
+        stream_with_context(iter_task_events(task_id, cursor)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Repositorios de Hugging Face de los modelos locales
+MODEL_REPOS = {
+    'blip': "Salesforce/blip-image-captioning-base",
+    'blip2': "Salesforce/blip2-flan-t5-xl"
+}
+
+# Backends de inferencia por modelo: PyTorch (todos) u ONNX Runtime (solo BLIP)
+MODEL_BACKENDS = {'blip': ('pytorch', 'onnx'), 'blip2': ('pytorch',)}
+BLIP_ONNX_EXPORT_VERSION = 1  # Incrementar si cambian los grafos exportados
+
+# Snapshots locales de los modelos (python provision_models.py): sin resolución en el hub al cargar
+SNAPSHOT_MANIFEST = 'snapshot.json'
+SNAPSHOT_PATTERNS = ['*.json', '*.safetensors', '*.txt', '*.model']  # Solo pesos safetensors (mmap al cargar)
+
+def get_snapshot_dir(model_name):
+    """Directorio del snapshot local de un modelo: models.snapshot_dir/<org>--<repo>"""
+    snapshot_root = CONFIG.get("models", {}).get("snapshot_dir", "models")
+    return os.path.join(snapshot_root, MODEL_REPOS[model_name].replace('/', '--'))
+
+def get_model_source(model_name):
+    """Origen de los pesos: (ruta del snapshot, True) si está aprovisionado; si no (repo del hub, False)"""
+    snapshot_dir = get_snapshot_dir(model_name)
+    if os.path.exists(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST)):
+        return snapshot_dir, True
+    if CONFIG.get("models", {}).get("offline", False):
+        raise FileNotFoundError(f"Modo offline sin snapshot de {model_name} en {snapshot_dir} (ejecuta: python provision_models.py {model_name})")
+    return MODEL_REPOS[model_name], False
+
+def provision_model_snapshot(model_name, revision=None, force=False):
+    """Descargar un modelo a su snapshot local fijando el commit del repo; devuelve el manifiesto"""
+    from huggingface_hub import HfApi, snapshot_download
+    
+    repo_id = MODEL_REPOS[model_name]
+    snapshot_dir = get_snapshot_dir(model_name)
+    manifest_path = os.path.join(snapshot_dir, SNAPSHOT_MANIFEST)
+    # Una rama o etiqueta se resuelve a su commit: el snapshot se compara siempre por hash
+    commit = HfApi().model_info(repo_id, revision=revision).sha if revision is not None else None
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if commit is None or commit == manifest['revision']:
+            print(f"✅ {model_name} ya aprovisionado en {snapshot_dir} ({manifest['revision'][:12]})")
+            return manifest
+    
+    if commit is None:
+        commit = HfApi().model_info(repo_id).sha
+    print(f"📥 Descargando {repo_id}@{commit[:12]} en {snapshot_dir}...")
+    
+    # Descargar en un directorio temporal y moverlo al final: nunca queda un snapshot a medias
+    snapshot_root = os.path.dirname(snapshot_dir) or '.'
+    os.makedirs(snapshot_root, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=snapshot_root)
+    try:
+        snapshot_download(repo_id, revision=commit, local_dir=temp_dir, allow_patterns=SNAPSHOT_PATTERNS)
+        shutil.rmtree(os.path.join(temp_dir, '.cache'), ignore_errors=True)
+        files = sorted(os.path.relpath(os.path.join(root, name), temp_dir)
+                       for root, _, names in os.walk(temp_dir) for name in names)
+        manifest = {
+            'model': model_name,
+            'repo': repo_id,
+            'revision': commit,
+            'files': files,
+            'size_mb': round(sum(os.path.getsize(os.path.join(temp_dir, name)) for name in files) / 1024**2, 1),
+            'created_at': time.time()
+        }
+        with open(os.path.join(temp_dir, SNAPSHOT_MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        
+        if os.path.exists(snapshot_dir):
+            shutil.rmtree(snapshot_dir)
+        os.replace(temp_dir, snapshot_dir)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    
+    print(f"✅ {model_name} aprovisionado: {len(files)} archivos, {manifest['size_mb']}MB")
+    return manifest
+
+def get_model_backend(model_name):
+    """Backend configurado para un modelo (models.backends en config.json); PyTorch si no está soportado"""
+    backend = CONFIG.get("models", {}).get("backends", {}).get(model_name, 'pytorch')
+    if backend not in MODEL_BACKENDS.get(model_name, ('pytorch',)):
+        print(f"⚠️ Backend '{backend}' no soportado para {model_name}, usando PyTorch")
+        return 'pytorch'
+    return backend
+
+def get_onnx_config():
+    """Obtener configuración de ONNX Runtime desde config.json"""
+    models_config = CONFIG.get("models", {})
+    threads = int(models_config.get("onnx_threads", 0))
+    return {
+        'dir': models_config.get("onnx_dir", "cache/onnx"),
+        # 0 = un hilo intra-op por CPU
+        'threads': threads if threads > 0 else (os.cpu_count() or 1)
+    }
+
+# Precisión de los pesos por modo: int8 carga en fp32 y cuantiza después las capas lineales
+PRECISION_DTYPES = {'fp32': 'float32', 'bf16': 'bfloat16', 'fp16': 'float16', 'int8': 'float32'}
+# Modos válidos por tipo de dispositivo (el primero es el de 'auto')
+DEVICE_PRECISIONS = {'cuda': ('fp16', 'bf16', 'fp32'), 'cpu': ('fp32', 'bf16', 'int8')}
+
+def get_configured_precision(model_name):
+    """Precisión configurada en models.precision sin resolver 'auto' (no importa torch ni detecta la GPU)"""
+    # El backend ONNX exporta siempre en fp32
+    if get_model_backend(model_name) == 'onnx':
+        return 'fp32'
+    return CONFIG.get("models", {}).get("precision", {}).get(model_name, 'auto')
+
+def get_model_precision(model_name, device_type=None):
+    """Precisión de un modelo según models.precision y el dispositivo ('auto': fp16 en GPU, fp32 en CPU)"""
+    precision = get_configured_precision(model_name)
+    if get_model_backend(model_name) == 'onnx':
+        return precision
+    device_type = device_type or get_device().type
+    allowed = DEVICE_PRECISIONS.get(device_type, DEVICE_PRECISIONS['cpu'])
+    if precision == 'auto':
+        return allowed[0]
+    if precision not in allowed:
+        print(f"⚠️ Precisión '{precision}' no soportada en {device_type} para {model_name}, usando {allowed[0]}")
+        return allowed[0]
+    return precision
+
+def apply_model_precision(model, precision):
+    """Cuantización dinámica int8 de las capas lineales (solo CPU); el resto de modos se aplica al cargar con torch_dtype"""
+    if precision != 'int8':
+        return model
+    import torch
+    
+    with warnings.catch_warnings():
+        # torch.ao.quantization está marcado como obsoleto en las versiones recientes de PyTorch
+        warnings.simplefilter('ignore')
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+class OnnxBlipCaptioner:
+    """BLIP ejecutado con ONNX Runtime: codificador de visión + decodificador con KV cache y beam search propio"""
+    backend = 'onnx'
+    
+    def __init__(self, export_dir, threads):
+        import onnxruntime as ort
+        
+        with open(os.path.join(export_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = [provider for provider in ('CUDAExecutionProvider', 'CPUExecutionProvider')
+                     if provider in ort.get_available_providers() and (provider == 'CPUExecutionProvider' or get_device().type == 'cuda')]
+        
+        self.sessions = {name: ort.InferenceSession(os.path.join(export_dir, f'{name}.onnx'), options, providers=providers)
+                         for name in ('vision', 'cross_kv', 'decoder')}
+        self.size_mb = sum(os.path.getsize(os.path.join(export_dir, f'{name}.onnx')) for name in self.sessions) / 1024**2
+    
+    def encode(self, pixel_values):
+        """pixel_values (batch, 3, H, W) -> image_embeds (batch, tokens, hidden)"""
+        return self.sessions['vision'].run(None, {'pixel_values': pixel_values.astype('float32')})[0]
+    
+    def generate(self, image_embeds, max_length=20, min_length=0, num_beams=1, do_sample=False, temperature=1.0,
+                 num_return_sequences=1, early_stopping=True, repetition_penalty=1.0, no_repeat_ngram_size=0, length_penalty=1.0):
+        """Beam search (o beam sampling) con los mismos parámetros que generate() de transformers; devuelve los token ids"""
+        import numpy as np
+        
+        meta = self.meta
+        eos, pad = meta['eos_token_id'], meta['pad_token_id']
+        batch_size = image_embeds.shape[0]
+        rows = batch_size * num_beams
+        rng = np.random.default_rng()
+        
+        # KV de cross-attention una vez por imagen, replicada para cada beam
+        cross_kv = self.sessions['cross_kv'].run(None, {'image_embeds': image_embeds.astype(np.float32)})[0]
+        cross_kv = np.repeat(cross_kv, num_beams, axis=1)
+        past_kv = np.zeros((2 * meta['num_layers'], rows, meta['num_heads'], 0, meta['head_size']), dtype=np.float32)
+        
+        sequences = np.full((rows, 1), meta['bos_token_id'], dtype=np.int64)
+        beam_scores = np.full((batch_size, num_beams), -1e9)
+        beam_scores[:, 0] = 0.0
+        hypotheses = [[] for _ in range(batch_size)]  # (score, tokens) de las secuencias terminadas
+        done = [False] * batch_size
+        
+        for length in range(1, max_length):
+            logits, past_kv = self.sessions['decoder'].run(None, {'input_ids': sequences[:, -1:], 'past_kv': past_kv, 'cross_kv': cross_kv})
+            scores = logits.astype(np.float64)
+            scores = scores - scores.max(axis=-1, keepdims=True)
+            scores = scores - np.log(np.exp(scores).sum(axis=-1, keepdims=True))
+            
+            # Procesadores de logits: penalización de repetición, n-gramas repetidos y longitud mínima
+            if repetition_penalty != 1.0:
+                seen = np.take_along_axis(scores, sequences, axis=1)
+                np.put_along_axis(scores, sequences, np.where(seen < 0, seen * repetition_penalty, seen / repetition_penalty), axis=1)
+            if no_repeat_ngram_size and length >= no_repeat_ngram_size:
+                prefix_size = no_repeat_ngram_size - 1
+                windows = np.lib.stride_tricks.sliding_window_view(sequences[:, :length - 1], prefix_size, axis=1) if prefix_size else None
+                for row in range(rows):
+                    if prefix_size:
+                        matches = np.nonzero((windows[row] == sequences[row, length - prefix_size:]).all(axis=1))[0]
+                        scores[row, sequences[row, matches + prefix_size]] = -np.inf
+                    else:
+                        scores[row, sequences[row]] = -np.inf
+            if length < min_length:
+                scores[:, eos] = -np.inf
+            if do_sample:
+                scores = scores / temperature
+            last_step = length == max_length - 1
+            
+            # Mejores 2 * num_beams continuaciones por imagen (con muestreo: Gumbel top-k = muestreo sin reemplazo)
+            vocab_size = scores.shape[-1]
+            candidates = (scores + beam_scores.reshape(-1, 1)).reshape(batch_size, -1)
+            ranking = candidates + rng.gumbel(size=candidates.shape) if do_sample else candidates
+            top = np.argpartition(-ranking, 2 * num_beams, axis=1)[:, :2 * num_beams]
+            top = np.take_along_axis(top, np.argsort(-np.take_along_axis(candidates, top, axis=1), axis=1), axis=1)
+            
+            next_rows = np.zeros(rows, dtype=np.int64)
+            next_tokens = np.full(rows, pad, dtype=np.int64)
+            next_scores = np.full((batch_size, num_beams), -1e9)
+            for batch_index in range(batch_size):
+                if done[batch_index]:
+                    next_rows[batch_index * num_beams:(batch_index + 1) * num_beams] = batch_index * num_beams
+                    continue
+                chosen = 0
+                for rank, candidate in enumerate(top[batch_index]):
+                    score = candidates[batch_index, candidate]
+                    if not np.isfinite(score):
+                        break
+                    row = batch_index * num_beams + candidate // vocab_size
+                    token = candidate % vocab_size
+                    if token == eos or last_step:
+                        # Solo cuentan como terminadas las secuencias que estarían entre los num_beams mejores
+                        # (en el último paso todas las candidatas terminan por longitud máxima)
+                        if rank < num_beams:
+                            hypotheses[batch_index].append((score / (length ** length_penalty), sequences[row].tolist() + [int(token)]))
+                        continue
+                    next_rows[batch_index * num_beams + chosen] = row
+                    next_tokens[batch_index * num_beams + chosen] = token
+                    next_scores[batch_index, chosen] = score
+                    chosen += 1
+                    if chosen == num_beams:
+                        break
+                
+                finished = sorted(hypotheses[batch_index], key=lambda hypothesis: hypothesis[0], reverse=True)[:num_beams]
+                hypotheses[batch_index] = finished
+                if len(finished) >= num_beams:
+                    best_running = next_scores[batch_index].max() / (length ** length_penalty)
+                    done[batch_index] = early_stopping is True or best_running <= finished[-1][0]
+            
+            if all(done):
+                break
+            sequences = np.concatenate([sequences[next_rows], next_tokens[:, None]], axis=1)
+            past_kv = past_kv[:, next_rows]
+            beam_scores = next_scores
+        
+        outputs = []
+        for batch_index in range(batch_size):
+            outputs += [tokens for _, tokens in hypotheses[batch_index][:num_return_sequences]]
+        
+        # Igual que transformers: sin pad_token_id propio se rellena con el token de fin
+        fill = pad if pad else eos
+        longest = max(len(tokens) for tokens in outputs)
+        return np.array([tokens + [fill] * (longest - len(tokens)) for tokens in outputs], dtype=np.int64)
+
+def load_blip_onnx(source=None, local=False):
+    """Cargar BLIP en ONNX Runtime, exportando los grafos la primera vez (se guardan en disco)
+
+    source/local: origen de los pesos para la exportación (ver get_model_source()).
+    """
+    import torch
+    import transformers
+    from transformers import BlipForConditionalGeneration
+    from blip_onnx_export import export_blip_onnx
+    
+    onnx_config = get_onnx_config()
+    signature_params = [MODEL_REPOS['blip'], transformers.__version__, BLIP_ONNX_EXPORT_VERSION]
+    if local:
+        # Un snapshot con otro commit del repo necesita su propia exportación
+        with open(os.path.join(source, SNAPSHOT_MANIFEST), 'r', encoding='utf-8') as f:
+            signature_params.append(json.load(f)['revision'])
+    signature = hashlib.sha256(json.dumps(signature_params).encode('utf-8')).hexdigest()[:12]
+    export_dir = os.path.join(onnx_config['dir'], f"blip-{signature}")
+    
+    if not os.path.exists(os.path.join(export_dir, 'meta.json')):
+        print(f"📦 Exportando BLIP a ONNX en {export_dir} (solo la primera vez)...")
+        torch_model = BlipForConditionalGeneration.from_pretrained(source or MODEL_REPOS['blip'], use_safetensors=True,
+                                                                   local_files_only=local, torch_dtype=torch.float32).eval()
+        os.makedirs(onnx_config['dir'], exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=onnx_config['dir'])
+        try:
+            export_blip_onnx(torch_model, temp_dir, BLIP_ONNX_EXPORT_VERSION)
+            os.replace(temp_dir, export_dir)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        del torch_model
+        print("✅ BLIP exportado a ONNX")
+    
+    captioner = OnnxBlipCaptioner(export_dir, onnx_config['threads'])
+    print(f"✅ BLIP cargado con ONNX Runtime ({onnx_config['threads']} hilos intra-op, {', '.join(captioner.sessions['decoder'].get_providers())})")
+    return captioner
 
 def load_model_on_demand(model_name, task_id=None):
     """Cargar modelo específico bajo demanda"""
     global current_loaded_model, models, processors, model_loading_status, progress_data
+    # Importaciones pesadas diferidas hasta la primera carga de un modelo local
+    import torch
+    from transformers import BlipProcessor, BlipForConditionalGeneration
+    from transformers import Blip2Processor, Blip2ForConditionalGeneration
     
     # Si el modelo ya está cargado, no hacer nada
-    if current_loaded_model == model_name and model_loading_status.get(model_name, {}).get('loaded', False):
+    if model_loading_status.get(model_name, {}).get('loaded', False):
+        current_loaded_model = model_name
         return True
     
-    # Descargar modelo anterior si es diferente
-    if current_loaded_model and current_loaded_model != model_name:
-        unload_model(current_loaded_model)
+    # Los modelos anteriores ya no se descargan aquí: el registro de modelos decide
+    # cuándo liberarlos (inactividad o presupuesto de memoria), ver acquire_model()
     
     print(f"🔄 Cargando modelo {model_name}...")
-    print(f"📥 Descargando modelo {model_name} desde Hugging Face...")
-    print(f"⏳ Esto puede tomar varios minutos en la primera descarga...")
     
     # Actualizar progreso si se proporciona task_id
     if task_id and task_id in progress_data:
         progress_data[task_id]['status'] = 'downloading_model'
         progress_data[task_id]['message'] = f'Cargando modelo {model_name} en memoria...'
-        progress_data[task_id]['progress'] = 10
+        notify_task_update(task_id)
     
     try:
-        if model_name == 'blip':
-            print(f"📦 Descargando modelo BLIP: Salesforce/blip-image-captioning-base")
-            print(f"🔧 Configuración: use_safetensors=True, torch_dtype=torch.float16")
-            models['blip'] = BlipForConditionalGeneration.from_pretrained(
-                "Salesforce/blip-image-captioning-base", 
+        # Snapshot local aprovisionado (sin tráfico al hub) o descarga desde Hugging Face
+        source, local = get_model_source(model_name)
+        if local:
+            print(f"📂 Cargando {model_name} desde el snapshot local {source}")
+        else:
+            print(f"📥 Descargando modelo {model_name} desde Hugging Face...")
+            print("⏳ Esto puede tomar varios minutos en la primera descarga...")
+        
+        if model_name == 'blip' and get_model_backend('blip') == 'onnx':
+            models['blip'] = load_blip_onnx(source, local)
+            processors['blip'] = BlipProcessor.from_pretrained(source, use_fast=True, local_files_only=local)
+            print("✅ Procesador BLIP descargado")
+            
+        elif model_name == 'blip':
+            precision = get_model_precision('blip')
+            print(f"📦 Descargando modelo BLIP: {source}")
+            print(f"🔧 Configuración: use_safetensors=True, precisión {precision}")
+            models['blip'] = apply_model_precision(BlipForConditionalGeneration.from_pretrained(
+                source, 
                 use_safetensors=True,
-                torch_dtype=torch.float16
-            ).to(device)
-            print(f"✅ Modelo BLIP descargado y cargado en {device}")
+                local_files_only=local,
+                torch_dtype=getattr(torch, PRECISION_DTYPES[precision])
+            ).to(get_device()), precision)
+            print(f"✅ Modelo BLIP descargado y cargado en {get_device()} ({precision})")
             
             print(f"📦 Descargando procesador BLIP...")
-            processors['blip'] = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base", use_fast=True)
+            processors['blip'] = BlipProcessor.from_pretrained(source, use_fast=True, local_files_only=local)
             print(f"✅ Procesador BLIP descargado")
             
         elif model_name == 'blip2':
-            print(f"📦 Descargando modelo BLIP2: Salesforce/blip2-flan-t5-xl")
-            print(f"🔧 Configuración: use_safetensors=True, torch_dtype=torch.float16, device_map=auto")
-            models['blip2'] = Blip2ForConditionalGeneration.from_pretrained(
-                "Salesforce/blip2-flan-t5-xl", 
-                torch_dtype=torch.float16,
-                use_safetensors=True,
-                device_map="auto"
-            )
-            print(f"✅ Modelo BLIP2 descargado y cargado con device_map=auto")
+            precision = get_model_precision('blip2')
+            print(f"📦 Descargando modelo BLIP2: {source}")
+            if get_device().type == 'cuda':
+                print(f"🔧 Configuración: use_safetensors=True, precisión {precision}, device_map=auto")
+                models['blip2'] = Blip2ForConditionalGeneration.from_pretrained(
+                    source, 
+                    torch_dtype=getattr(torch, PRECISION_DTYPES[precision]),
+                    use_safetensors=True,
+                    local_files_only=local,
+                    device_map="auto"
+                )
+                print(f"✅ Modelo BLIP2 descargado y cargado con device_map=auto ({precision})")
+            else:
+                # En CPU no hay nada que repartir; sin hooks de accelerate el modelo se puede cuantizar
+                print(f"🔧 Configuración: use_safetensors=True, precisión {precision}")
+                models['blip2'] = apply_model_precision(Blip2ForConditionalGeneration.from_pretrained(
+                    source, 
+                    torch_dtype=getattr(torch, PRECISION_DTYPES[precision]),
+                    use_safetensors=True,
+                    local_files_only=local
+                ), precision)
+                print(f"✅ Modelo BLIP2 descargado y cargado en CPU ({precision})")
             
             print(f"📦 Descargando procesador BLIP2...")
-            processors['blip2'] = Blip2Processor.from_pretrained("Salesforce/blip2-flan-t5-xl", use_fast=True)
+            processors['blip2'] = Blip2Processor.from_pretrained(source, use_fast=True, local_files_only=local)
             print(f"✅ Procesador BLIP2 descargado")
             
         
         # Modelos WD14 eliminados
         
         # Actualizar estado
-        model_loading_status[model_name]['loaded'] = True
+        model_loading_status.setdefault(model_name, {'available': True})['loaded'] = True
         current_loaded_model = model_name
         
         # Actualizar progreso si se proporciona task_id
         if task_id and task_id in progress_data:
             progress_data[task_id]['status'] = 'processing'
-            progress_data[task_id]['message'] = f'Cargando modelo {model_name} en memoria...'
-            progress_data[task_id]['progress'] = 0
+            progress_data[task_id]['message'] = ''
+            notify_task_update(task_id)
         
         print(f"🎉 Modelo {model_name} cargado exitosamente y listo para generar captions")
         print(f"💾 Memoria GPU utilizada: {torch.cuda.memory_allocated() / 1024**3:.2f} GB" if torch.cuda.is_available() else "💾 Usando CPU")
@@ -725,7 +1828,7 @@ def load_model_on_demand(model_name, task_id=None):
         print(f"❌ Error cargando modelo {model_name}: {e}")
         print(f"❌ Tipo de error: {type(e).__name__}")
         print(f"🔍 Verifica que tienes conexión a internet y espacio suficiente en disco")
-        model_loading_status[model_name]['available'] = False
+        model_loading_status.setdefault(model_name, {'loaded': False})['available'] = False
         return False
 
 def unload_model(model_name):
@@ -748,8 +1851,12 @@ def unload_model(model_name):
         
         # Modelos WD14 eliminados
         
+        # Las salidas del codificador en caché pertenecen al modelo descargado
+        clear_encoder_cache(model_name)
+        
         # Limpiar cache de CUDA si está disponible
-        if torch.cuda.is_available():
+        if get_device().type == 'cuda':
+            import torch
             torch.cuda.empty_cache()
         
         # Actualizar estado
@@ -763,379 +1870,1007 @@ def unload_model(model_name):
     except Exception as e:
         print(f"❌ Error descargando modelo {model_name}: {e}")
 
-def generate_caption(image_path, model_name='blip', keyword='', min_words=0, consistency_mode='auto', custom_prompt=''):
-    """Generar caption para una imagen"""
-    try:
-        # Cargar imagen
-        image = Image.open(image_path).convert('RGB')
-        
-        # Cargar modelo bajo demanda
-        if not load_model_on_demand(model_name):
-            return f"Error: No se pudo cargar el modelo {model_name}"
-        
-        # Generar caption según el modelo
-        # Modelos WD14 eliminados
-        if model_name == 'blip' and models.get('blip') is not None:
-            caption = generate_caption_blip(image, min_words)
-        elif model_name == 'blip2' and models.get('blip2') is not None:
-            caption = generate_caption_blip2(image, min_words)
-        elif model_name == 'llama-vision':
-            # Para Llama Vision, usar prompt personalizado o uno por defecto
-            prompt = custom_prompt if custom_prompt else "Describe this image in detail."
-            caption = generate_caption_llama_vision(image, prompt)
-        else:
-            return f"Modelo {model_name} no disponible"
-        
-        # Aplicar reglas de consistencia para términos de personas
-        caption = apply_consistency_rules(caption, consistency_mode)
-        
-        # Aplicar keyword si se especifica
-        if keyword:
-            caption = f"{keyword} {caption}"
-        
-        # Aplicar límites de palabras (solo para BLIP/BLIP2, no para Llama Vision)
-        if model_name in ['blip', 'blip2']:
-            caption = apply_word_limits(caption, min_words)
-            
-            # Si apply_word_limits devuelve None, significa que el caption es muy corto
-            # y necesitamos regenerarlo con parámetros más largos
-            if caption is None:
-                # Regenerar con parámetros más largos
-                if model_name == 'blip' and models.get('blip') is not None:
-                    caption = generate_caption_blip(image, min_words)
-                elif model_name == 'blip2' and models.get('blip2') is not None:
-                    caption = generate_caption_blip2(image, min_words)
-                
-                # Aplicar consistencia y keyword al caption regenerado
-                caption = apply_consistency_rules(caption, consistency_mode)
-                if keyword:
-                    caption = f"{keyword} {caption}"
-        else:
-            # Para Llama Vision y otros modelos, usar el caption tal como viene
-            caption = caption.strip()
-        
-        return caption
-            
-    except Exception as e:
-        return f"Error procesando imagen: {str(e)}"
+# Registro de modelos locales compartidos entre hilos (leases con conteo de referencias)
+LOCAL_MODELS = ['blip', 'blip2']
+model_registry = {}  # model_name -> {'loaded', 'refs', 'last_used', 'size_mb', 'loads'}
+model_registry_lock = threading.Lock()  # Protege model_registry
+model_load_lock = threading.RLock()  # Serializa cargas y descargas (models/processors)
+model_janitor_thread = None
 
-def apply_consistency_rules(caption, consistency_mode='auto'):
-    """Aplicar reglas de consistencia para términos de personas"""
-    print(f"🔧 Aplicando consistencia: modo='{consistency_mode}', caption original='{caption}'")
-    
-    if consistency_mode == 'none':
-        print("❌ Modo 'none' - no se aplica consistencia")
-        return caption
-    
-    # Diccionario de términos de personas detectables
-    person_terms = {
-        # Términos femeninos
-        'girl': 'girl',
-        'little girl': 'little girl', 
-        'young girl': 'young girl',
-        'teenage girl': 'teenage girl',
-        'teen girl': 'teen girl',
-        'female': 'female',
-        'lady': 'lady',
-        'woman': 'woman',
-        
-        # Términos masculinos
-        'boy': 'boy',
-        'little boy': 'little boy',
-        'young boy': 'young boy', 
-        'teenage boy': 'teenage boy',
-        'teen boy': 'teen boy',
-        'male': 'male',
-        'gentleman': 'gentleman',
-        'man': 'man',
-        
-        # Términos neutros/plurales
-        'people': 'people',
-        'person': 'person',
-        'persons': 'persons',
-        'individual': 'individual',
-        'child': 'child',
-        'children': 'children',
-        'kids': 'kids',
-        'kid': 'kid'
-    }
-    
-    # Si el modo es específico, usar ese término exacto
-    if consistency_mode in ['woman', 'girl', 'little girl', 'young girl', 'man', 'boy', 'person']:
-        target_term = consistency_mode
-        print(f"✅ Modo específico: usando '{target_term}'")
-    else:
-        # Modo automático: detectar el término predominante
-        target_term = detect_predominant_person_term(caption, person_terms)
-        print(f"🤖 Modo automático: detectado '{target_term}'")
-    
-    # Aplicar normalización
-    words = caption.lower().split()
-    normalized_words = []
-    
-    for i, word in enumerate(words):
-        # Buscar términos de 1-3 palabras
-        found_replacement = False
-        
-        # Buscar términos de 3 palabras
-        if i + 2 < len(words):
-            three_word_term = f"{word} {words[i+1]} {words[i+2]}"
-            if three_word_term in person_terms:
-                normalized_words.append(target_term)
-                # Saltar las siguientes 2 palabras
-                words[i+1] = ''
-                words[i+2] = ''
-                found_replacement = True
-        
-        # Buscar términos de 2 palabras
-        if not found_replacement and i + 1 < len(words):
-            two_word_term = f"{word} {words[i+1]}"
-            if two_word_term in person_terms:
-                normalized_words.append(target_term)
-                # Saltar la siguiente palabra
-                words[i+1] = ''
-                found_replacement = True
-        
-        # Buscar términos de 1 palabra
-        if not found_replacement and word in person_terms:
-            normalized_words.append(target_term)
-            found_replacement = True
-        
-        # Si no se encontró reemplazo, mantener la palabra original
-        if not found_replacement and word != '':
-            normalized_words.append(word)
-    
-    result = ' '.join(normalized_words)
-    print(f"📝 Resultado final: '{result}'")
-    return result
-
-def detect_predominant_person_term(caption, person_terms):
-    """Detectar el término de persona predominante en el caption"""
-    words = caption.lower().split()
-    
-    # Contar términos específicos
-    term_counts = {
-        'woman': 0,
-        'girl': 0,
-        'little girl': 0,
-        'young girl': 0,
-        'man': 0,
-        'boy': 0,
-        'person': 0
+def get_models_config():
+    """Obtener configuración del registro de modelos desde config.json"""
+    models_config = CONFIG.get("models", {})
+    return {
+        'idle_ttl_seconds': float(models_config.get("idle_ttl_seconds", 600)),
+        'memory_budget_mb': float(models_config.get("memory_budget_mb", 0))
     }
+
+def estimate_model_size_mb(model):
+    """Estimar la memoria ocupada por los pesos y buffers de un modelo"""
+    if model is None:
+        return 0.0
+    # Backends sin parámetros de PyTorch (ONNX Runtime) informan de su propio tamaño
+    if hasattr(model, 'size_mb'):
+        return model.size_mb
+    import torch
     
-    for i, word in enumerate(words):
-        # Buscar términos de 3 palabras
-        if i + 2 < len(words):
-            three_word_term = f"{word} {words[i+1]} {words[i+2]}"
-            if three_word_term in person_terms:
-                term = person_terms[three_word_term]
-                if term in term_counts:
-                    term_counts[term] += 1
-                # Saltar las siguientes 2 palabras
-                words[i+1] = ''
-                words[i+2] = ''
-                continue
-        
-        # Buscar términos de 2 palabras
-        if i + 1 < len(words):
-            two_word_term = f"{word} {words[i+1]}"
-            if two_word_term in person_terms:
-                term = person_terms[two_word_term]
-                if term in term_counts:
-                    term_counts[term] += 1
-                # Saltar la siguiente palabra
-                words[i+1] = ''
-                continue
-        
-        # Buscar términos de 1 palabra
-        if word in person_terms:
-            term = person_terms[word]
-            if term in term_counts:
-                term_counts[term] += 1
-    
-    # Determinar el término predominante
-    # Priorizar términos femeninos específicos
-    if term_counts['little girl'] > 0:
-        return 'little girl'
-    elif term_counts['young girl'] > 0:
-        return 'young girl'
-    elif term_counts['girl'] > 0:
-        return 'girl'
-    elif term_counts['woman'] > 0:
-        return 'woman'
-    elif term_counts['boy'] > 0:
-        return 'boy'
-    elif term_counts['man'] > 0:
-        return 'man'
-    elif term_counts['person'] > 0:
-        return 'person'
-    else:
-        return 'person'  # Por defecto si no se detecta nada
+    total_bytes = sum(t.numel() * t.element_size() for t in model.parameters())
+    total_bytes += sum(t.numel() * t.element_size() for t in model.buffers())
+    # Las capas lineales cuantizadas (int8) guardan los pesos empaquetados, fuera de parameters()
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            total_bytes += sum(t.numel() * t.element_size() for t in (module.weight(), module.bias()) if t is not None)
+    return total_bytes / 1024**2
 
-def apply_word_limits(caption, min_words=0):
-    """Aplicar límites de palabras al caption"""
-    words = caption.strip().split()
-    word_count = len(words)
+def acquire_model(model_name, task_id=None):
+    """Obtener un lease sobre un modelo, cargándolo solo si ningún otro hilo lo tiene ya en memoria"""
+    # Los modelos remotos (Llama Vision) no ocupan memoria local
+    if model_name not in LOCAL_MODELS:
+        return True
     
-    # Si no se especifican límites, usar valores por defecto
-    if min_words == 0:
-        min_words = 15  # Mínimo por defecto: 15 palabras
+    # Camino rápido: el modelo ya está cargado y se comparte la instancia
+    with model_registry_lock:
+        entry = model_registry.get(model_name)
+        if entry and entry['loaded']:
+            entry['refs'] += 1
+            entry['last_used'] = time.time()
+            return True
     
-    # Si el caption es muy corto, intentar regenerar con parámetros más largos
-    if word_count < min_words:
-        # Para captions muy cortos, intentar regenerar con max_length más alto
-        return None  # Indicar que se necesita regenerar
+    with model_load_lock:
+        with model_registry_lock:
+            entry = model_registry.setdefault(model_name, {'loaded': False, 'refs': 0, 'last_used': time.time(), 'size_mb': 0.0, 'loads': 0})
+            # Otro hilo pudo terminar la carga mientras esperábamos
+            if entry['loaded']:
+                entry['refs'] += 1
+                entry['last_used'] = time.time()
+                return True
+            expected_size_mb = entry['size_mb']
+        
+        # Liberar modelos inactivos si la carga (con el tamaño de la última vez) excede el presupuesto
+        enforce_model_memory_budget(keep=None, reserve_mb=expected_size_mb)
+        
+        started_at = time.time()
+        start = time.perf_counter()
+        loaded = load_model_on_demand(model_name, task_id)
+        seconds = time.perf_counter() - start
+        metrics_observe('captioning_model_load_seconds', seconds, model=model_name)
+        trace_event('model_load', model_name, started_at, seconds)
+        metrics_inc('captioning_model_loads_total', model=model_name, result='ok' if loaded else 'error')
+        if not loaded:
+            return False
+        
+        with model_registry_lock:
+            entry['loaded'] = True
+            entry['refs'] += 1
+            entry['loads'] += 1
+            entry['last_used'] = time.time()
+            entry['size_mb'] = estimate_model_size_mb(models.get(model_name))
+        
+        enforce_model_memory_budget(keep=model_name)
     
-    return caption.strip()
+    start_model_janitor()
+    return True
 
-def generate_caption_blip(image, min_words=0):
-    """Generar caption con BLIP"""
+def release_model(model_name):
+    """Liberar un lease; el modelo queda en memoria hasta que expire su tiempo de inactividad"""
+    with model_registry_lock:
+        entry = model_registry.get(model_name)
+        if not entry:
+            return
+        entry['refs'] = max(0, entry['refs'] - 1)
+        entry['last_used'] = time.time()
+    
+    # Con idle_ttl_seconds = 0 se recupera el comportamiento anterior (descargar al terminar)
+    if get_models_config()['idle_ttl_seconds'] <= 0:
+        evict_idle_models()
+
+@contextmanager
+def model_lease(model_name, task_id=None):
+    """Context manager para usar un modelo durante un bloque: with model_lease('blip') as ok"""
+    acquired = acquire_model(model_name, task_id)
     try:
-        # Si no se especifican límites, usar valores por defecto
-        if min_words == 0:
-            min_words = 15  # Mínimo por defecto: 15 palabras
-        
-        # Calcular max_length basado en las palabras mínimas
-        max_length = max(min_words * 3, 50)  # Generar suficiente para el mínimo
-        
-        # Intentar generar caption con diferentes parámetros hasta cumplir el mínimo
-        for attempt in range(3):  # Máximo 3 intentos
-            # Ajustar parámetros según el intento - SIEMPRE con aleatoriedad
-            if attempt == 0:
-                # Primer intento: parámetros normales con aleatoriedad
-                num_beams = 7
-                temperature = 1.1  # Ligeramente aleatorio
-            elif attempt == 1:
-                # Segundo intento: más creativo para generar más palabras
-                num_beams = 5
-                temperature = 1.3
-                max_length = int(max_length * 1.5)
-            else:
-                # Tercer intento: muy creativo
-                num_beams = 3
-                temperature = 1.6
-                max_length = int(max_length * 2)
-        
-        inputs = processors['blip'](image, return_tensors="pt").to(device)
-        
-        # Calcular min_length en tokens (aproximadamente 1.3 tokens por palabra)
-        min_length_tokens = max(int(min_words * 1.3), 10)
-        
-        out = models['blip'].generate(
-            **inputs, 
-            max_length=max_length,
-            min_length=min_length_tokens,  # min_length en tokens, no palabras
-            num_beams=num_beams,
-            temperature=temperature,
-            do_sample=True,  # SIEMPRE usar muestreo para aleatoriedad
-            early_stopping=True,  # Activar para BLIP
-            repetition_penalty=1.2,  # Evitar repeticiones
-            no_repeat_ngram_size=3   # Evitar n-gramas repetidos
-        )
-        caption = processors['blip'].decode(out[0], skip_special_tokens=True)
-        
-        # Limpiar repeticiones excesivas
-        caption = clean_blip_caption(caption)
-        
-        # Verificar si cumple el mínimo de palabras
-        word_count = len(caption.strip().split())
-        if word_count >= min_words:
-            return caption
-        
-        # Si después de 3 intentos no cumple el mínimo, devolver el mejor resultado
-        return caption
-        
-    except Exception as e:
-        return f"Error con BLIP: {str(e)}"
+        yield acquired
+    finally:
+        if acquired:
+            release_model(model_name)
 
-def clean_blip_caption(caption):
-    """Limpiar caption de BLIP de repeticiones excesivas"""
-    import re
+def evict_model(model_name):
+    """Descargar un modelo solo si no tiene leases activos"""
+    with model_load_lock:
+        with model_registry_lock:
+            entry = model_registry.get(model_name)
+            if not entry or not entry['loaded'] or entry['refs'] > 0:
+                return False
+            entry['loaded'] = False
+        with metrics_timer('captioning_model_unload_seconds', model=model_name):
+            unload_model(model_name)
+        metrics_inc('captioning_model_unloads_total', model=model_name)
+        return True
+
+def evict_idle_models():
+    """Descargar los modelos sin leases que superan el tiempo de inactividad configurado"""
+    idle_ttl = get_models_config()['idle_ttl_seconds']
+    now = time.time()
+    with model_registry_lock:
+        expired = [name for name, entry in model_registry.items()
+                   if entry['loaded'] and entry['refs'] == 0 and now - entry['last_used'] >= idle_ttl]
     
-    # Eliminar repeticiones excesivas de palabras
-    caption = re.sub(r'\b(\w+)\s+\1\s+\1\b', r'\1', caption)  # Palabras repetidas 3+ veces
-    caption = re.sub(r'\b(\w+)\s+\1\b', r'\1', caption)  # Palabras repetidas 2 veces
+    for model_name in expired:
+        print(f"⏱️ Modelo {model_name} inactivo durante más de {idle_ttl:.0f}s, descargando...")
+        evict_model(model_name)
+
+def enforce_model_memory_budget(keep=None, reserve_mb=0.0):
+    """Descargar modelos inactivos (LRU) mientras se supere memory_budget_mb"""
+    budget_mb = get_models_config()['memory_budget_mb']
+    if budget_mb <= 0:
+        return
     
-    # Eliminar frases repetitivas específicas
-    caption = re.sub(r'\b(her right hand|her left hand|her hand)\s+(on|in|with)\s+(her right hand|her left hand|her hand)\b', 'her hand', caption, flags=re.IGNORECASE)
+    while True:
+        with model_registry_lock:
+            used_mb = sum(entry['size_mb'] for entry in model_registry.values() if entry['loaded'])
+            if used_mb + reserve_mb <= budget_mb:
+                return
+            idle = sorted((entry['last_used'], name) for name, entry in model_registry.items()
+                          if entry['loaded'] and entry['refs'] == 0 and name != keep)
+        
+        if not idle:
+            print(f"⚠️ Presupuesto de memoria excedido ({used_mb + reserve_mb:.0f}MB > {budget_mb:.0f}MB) pero todos los modelos están en uso")
+            return
+        
+        model_name = idle[0][1]
+        print(f"💾 Presupuesto de memoria excedido ({used_mb + reserve_mb:.0f}MB > {budget_mb:.0f}MB), descargando {model_name}...")
+        evict_model(model_name)
+
+def start_model_janitor():
+    """Arrancar (una sola vez) el hilo que descarga modelos inactivos"""
+    global model_janitor_thread
     
-    # Eliminar repeticiones de artículos y preposiciones
-    caption = re.sub(r'\b(the|a|an|and|in|on|at|to|of|with|for)\s+\1\b', r'\1', caption, flags=re.IGNORECASE)
+    with model_registry_lock:
+        if model_janitor_thread is not None:
+            return
+        model_janitor_thread = threading.Thread(target=model_janitor_loop, daemon=True)
+        model_janitor_thread.start()
+
+def model_janitor_loop():
+    """Revisar periódicamente los modelos inactivos"""
+    while True:
+        idle_ttl = get_models_config()['idle_ttl_seconds']
+        time.sleep(min(max(idle_ttl / 4, 1.0), 60.0))
+        try:
+            evict_idle_models()
+        except Exception as e:
+            print(f"❌ Error revisando modelos inactivos: {e}")
+
+def get_model_registry_status():
+    """Obtener estado del registro de modelos para /api/models/status"""
+    now = time.time()
+    with model_registry_lock:
+        return {
+            name: {
+                'loaded': entry['loaded'],
+                'leases': entry['refs'],
+                'idle_seconds': round(now - entry['last_used'], 1) if entry['refs'] == 0 else 0,
+                'size_mb': round(entry['size_mb'], 1),
+                'loads': entry['loads']
+            }
+            for name, entry in model_registry.items()
+        }
+
+# Precarga al arrancar (models.preload): /api/health responde 503 hasta que termina
+model_preload_state = {'pending': [], 'failed': [], 'ready': True}
+
+def preload_models():
+    """Cargar los modelos de models.preload y fijarlos en memoria con un lease permanente"""
+    model_names = [name for name in CONFIG.get("models", {}).get("preload", []) if name in LOCAL_MODELS]
+    model_preload_state.update({'pending': list(model_names), 'failed': [], 'ready': not model_names})
+    
+    for model_name in model_names:
+        print(f"🔥 Precargando {model_name}...")
+        start = time.time()
+        # El lease no se libera: el modelo no se descarga por inactividad ni por el presupuesto de memoria
+        if acquire_model(model_name):
+            print(f"✅ {model_name} precargado en {time.time() - start:.1f}s")
+        else:
+            model_preload_state['failed'].append(model_name)
+            print(f"❌ No se pudo precargar {model_name}")
+        model_preload_state['pending'].remove(model_name)
+    
+    model_preload_state['ready'] = True
+
+def get_caption_batch_size():
+    """Obtener el tamaño de lote para BLIP/BLIP-2 desde config.json"""
+    return max(1, int(CONFIG.get("settings", {}).get("caption_batch_size", 4)))
+
+def get_caption_candidates():
+    """Candidatos por imagen en una sola llamada a generate() (1 = reintentos en serie si el caption es corto)"""
+    return max(1, int(CONFIG.get("settings", {}).get("caption_candidates", 3)))
+
+def select_caption_candidates(candidates, num_candidates, min_words):
+    """Elegir por imagen el primer candidato con min_words palabras (o el más largo si ninguno llega)"""
+    selected = []
+    for start in range(0, len(candidates), num_candidates):
+        group = candidates[start:start + num_candidates]
+        selected.append(next((caption for caption in group if len(caption.split()) >= min_words),
+                             max(group, key=lambda caption: len(caption.split()))))
+    return selected
+
+# Caché persistente de captions (SQLite), indexada por hash del contenido de la imagen + parámetros
+CAPTION_CACHE_VERSION = 1  # Incrementar si cambia la generación o la limpieza de captions
+caption_cache_db = None
+caption_cache_lock = threading.Lock()
+caption_cache_size_bytes = 0
+caption_cache_counters = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+def get_caption_cache_config():
+    """Obtener configuración de la caché de captions desde config.json"""
+    cache_config = CONFIG.get("caption_cache", {})
+    return {
+        'enabled': bool(cache_config.get("enabled", True)),
+        'path': cache_config.get("path", "cache/captions.sqlite3"),
+        'max_size_mb': float(cache_config.get("max_size_mb", 50))
+    }
+
+def is_deterministic_generation():
+    """Comprobar si la generación debe ser determinista (sin muestreo aleatorio)"""
+    return bool(CONFIG.get("settings", {}).get("deterministic_generation", False))
+
+def get_sampling_kwargs(temperature):
+    """Parámetros de muestreo para generate(); beam search puro si la generación es determinista"""
+    if is_deterministic_generation():
+        return {'do_sample': False}
+    return {'do_sample': True, 'temperature': temperature}
+
+def is_error_caption(caption):
+    """Detectar los mensajes de error que devuelven las funciones de generación"""
+    return caption.startswith('Error') or caption.startswith('Modelo ')
+
+@lru_cache(maxsize=4096)
+def hash_file_contents(file_path, mtime_ns, size):
+    """Calcular SHA-256 del contenido (memoizado por ruta, fecha de modificación y tamaño)"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def compute_file_hash(file_path):
+    """Obtener el hash del contenido de un archivo"""
+    # Los objetos direccionados por contenido ya llevan el hash en el nombre
+    name = os.path.basename(file_path)
+    if is_upload_id(name):
+        return name.split('.')[0]
+    stat = os.stat(file_path)
+    return hash_file_contents(file_path, stat.st_mtime_ns, stat.st_size)
+
+def get_caption_cache_db():
+    """Abrir (una sola vez) la base de datos SQLite de la caché; llamar con caption_cache_lock"""
+    global caption_cache_db, caption_cache_size_bytes
+    
+    if caption_cache_db is None:
+        db_path = get_caption_cache_config()['path']
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        caption_cache_db = sqlite3.connect(db_path, check_same_thread=False)
+        caption_cache_db.execute('PRAGMA journal_mode=WAL')
+        caption_cache_db.execute(
+            'CREATE TABLE IF NOT EXISTS captions ('
+            'key TEXT PRIMARY KEY, caption TEXT NOT NULL, size_bytes INTEGER NOT NULL, '
+            'created_at REAL NOT NULL, last_access REAL NOT NULL)'
+        )
+        caption_cache_db.execute('CREATE INDEX IF NOT EXISTS idx_captions_last_access ON captions(last_access)')
+        caption_cache_db.commit()
+        caption_cache_size_bytes = caption_cache_db.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM captions').fetchone()[0]
+        print(f"🗃️ Caché de captions abierta en {db_path} ({caption_cache_size_bytes / 1024**2:.1f}MB)")
+    return caption_cache_db
+
+def caption_cache_key(image_path, model_name, keyword='', min_words=0, consistency_mode='auto', custom_prompt=''):
+    """Construir la clave de caché: hash de la imagen + todos los parámetros que afectan al caption"""
+    if not get_caption_cache_config()['enabled']:
+        return None
+    
+    # El prompt y el modelo remoto solo influyen en Llama Vision
+    remote_model = CONFIG.get("settings", {}).get("openrouter_model", '') if model_name == 'llama-vision' else ''
+    prompt = custom_prompt if model_name == 'llama-vision' else ''
+    # Las listas de limpieza solo se aplican a BLIP-2
+    cleaning = caption_cleaning_signature if model_name == 'blip2' else ''
+    candidates = get_caption_candidates() if model_name in LOCAL_MODELS else 0
+    backend = get_model_backend(model_name) if model_name in LOCAL_MODELS else ''
+    # Precisión configurada, no la resuelta: un acierto de caché no debe importar torch
+    precision = get_configured_precision(model_name) if model_name in LOCAL_MODELS else ''
+    params = [CAPTION_CACHE_VERSION, compute_file_hash(image_path), model_name, remote_model,
+              keyword, min_words, consistency_mode, prompt, is_deterministic_generation(), cleaning, candidates, backend, precision]
+    return hashlib.sha256(json.dumps(params, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def caption_cache_get(key):
+    """Buscar un caption en la caché; None si no existe"""
+    if key is None:
+        return None
+    
+    with caption_cache_lock:
+        db = get_caption_cache_db()
+        row = db.execute('SELECT caption FROM captions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            caption_cache_counters['misses'] += 1
+            return None
+        db.execute('UPDATE captions SET last_access = ? WHERE key = ?', (time.time(), key))
+        db.commit()
+        caption_cache_counters['hits'] += 1
+        return row[0]
+
+def caption_cache_put(key, caption):
+    """Guardar un caption en la caché y expulsar los menos usados si se supera el tamaño máximo"""
+    global caption_cache_size_bytes
     
-    # Limpiar espacios múltiples
-    caption = re.sub(r'\s+', ' ', caption)
+    if key is None:
+        return
+    
+    size_bytes = len(key) + len(caption.encode('utf-8'))
+    now = time.time()
+    with caption_cache_lock:
+        db = get_caption_cache_db()
+        previous = db.execute('SELECT size_bytes FROM captions WHERE key = ?', (key,)).fetchone()
+        db.execute(
+            'INSERT OR REPLACE INTO captions (key, caption, size_bytes, created_at, last_access) VALUES (?, ?, ?, ?, ?)',
+            (key, caption, size_bytes, now, now)
+        )
+        caption_cache_size_bytes += size_bytes - (previous[0] if previous else 0)
+        caption_cache_counters['writes'] += 1
+        
+        # Expulsión LRU por tamaño
+        max_bytes = get_caption_cache_config()['max_size_mb'] * 1024**2
+        if caption_cache_size_bytes > max_bytes:
+            excess = caption_cache_size_bytes - max_bytes
+            evicted_keys = []
+            for old_key, old_size in db.execute('SELECT key, size_bytes FROM captions ORDER BY last_access ASC'):
+                if excess <= 0:
+                    break
+                evicted_keys.append((old_key,))
+                excess -= old_size
+                caption_cache_size_bytes -= old_size
+            db.executemany('DELETE FROM captions WHERE key = ?', evicted_keys)
+            caption_cache_counters['evictions'] += len(evicted_keys)
+        db.commit()
+
+def get_caption_cache_stats():
+    """Obtener estadísticas de la caché de captions"""
+    cache_config = get_caption_cache_config()
+    with caption_cache_lock:
+        lookups = caption_cache_counters['hits'] + caption_cache_counters['misses']
+        stats = {
+            'enabled': cache_config['enabled'],
+            'deterministic_generation': is_deterministic_generation(),
+            'max_size_mb': cache_config['max_size_mb'],
+            'hit_rate': round(caption_cache_counters['hits'] / lookups, 3) if lookups else 0.0,
+            **caption_cache_counters
+        }
+        if cache_config['enabled']:
+            stats['entries'] = get_caption_cache_db().execute('SELECT COUNT(*) FROM captions').fetchone()[0]
+            stats['size_mb'] = round(caption_cache_size_bytes / 1024**2, 3)
+        return stats
+
+def clear_caption_cache():
+    """Vaciar la caché de captions"""
+    global caption_cache_size_bytes
+    
+    with caption_cache_lock:
+        db = get_caption_cache_db()
+        db.execute('DELETE FROM captions')
+        db.commit()
+        caption_cache_size_bytes = 0
+
+def finalize_caption(caption, keyword='', consistency_mode='auto'):
+    """Aplicar reglas de consistencia y keyword a un caption generado"""
+    return finalize_captions([caption], keyword, consistency_mode)[0]
+
+def finalize_captions(captions, keyword='', consistency_mode='auto'):
+    """Aplicar reglas de consistencia y keyword a una lista de captions generados"""
+    # Aplicar reglas de consistencia para términos de personas
+    captions = apply_consistency_rules_batch(captions, consistency_mode)
+    
+    # Aplicar keyword si se especifica
+    if keyword:
+        captions = [f"{keyword} {caption}" for caption in captions]
+    return captions
+
+# Tamaño de entrada (ancho, alto) de los procesadores de BLIP/BLIP-2 si aún no están cargados
+CAPTION_INPUT_SIZES = {'blip': (384, 384), 'blip2': (224, 224)}
+
+def caption_input_size(model_name, image_size):
+    """Tamaño mínimo (ancho, alto) al que hay que decodificar una imagen para un modelo"""
+    if model_name == 'llama-vision':
+        # Mismas dimensiones finales que resize_image_maintain_aspect()
+        max_size = CONFIG["settings"]["remote_model_max_image_size"]
+        width, height = image_size
+        if width > height:
+            return max_size, max(1, int((height * max_size) / width))
+        return max(1, int((width * max_size) / height)), max_size
+    
+    # El procesador de BLIP/BLIP-2 redimensiona a un tamaño fijo sin mantener el aspect ratio
+    processor = processors.get(model_name)
+    size = getattr(getattr(processor, 'image_processor', None), 'size', None)
+    if size and 'height' in size and 'width' in size:
+        return size['width'], size['height']
+    return CAPTION_INPUT_SIZES.get(model_name)
+
+def load_caption_image(image_path, model_name):
+    """Abrir una imagen en RGB a la menor escala que todavía cubre la entrada del modelo
+
+    JPEG se decodifica directamente reducido (draft: 1/2, 1/4, 1/8); el resto de formatos
+    se reducen con reduce() entero tras decodificar, antes de pasar al procesador.
+    """
+    image = Image.open(image_path)
+    target = caption_input_size(model_name, image.size)
+    if not target:
+        return image.convert('RGB')
+    
+    image.draft('RGB', target)
+    image.load()  # Decodificar aquí (en el hilo de precarga), no al pasar por el procesador
+    # reduce() trabaja sobre RGB y escala de grises; paletas, alfa, CMYK... se convierten antes
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    factor = min(image.width // target[0], image.height // target[1])
+    if factor > 1:
+        image = image.reduce(factor)
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+def prepare_caption_batch(image_paths, model_name='blip', keyword='', min_words=0, consistency_mode='auto', refresh_cache=False, indices=None):
+    """Etapa previa al modelo: consultar la caché, decodificar las imágenes y ejecutar el procesador
+
+    No usa el modelo, por lo que el pipeline de precarga la ejecuta en segundo plano mientras
+    el modelo genera el lote anterior. indices son las posiciones de las imágenes en la tarea (para la traza).
+    """
+    batch = {'captions': [None] * len(image_paths), 'cache_keys': [None] * len(image_paths),
+             'images': [], 'image_keys': [], 'indices': [], 'positions': [], 'pixel_values': None}
+    indices = indices if indices is not None else list(range(len(image_paths)))
+    
+    # Cargar imágenes; un fallo solo afecta a su propia posición del lote
+    for index, image_path in enumerate(image_paths):
+        try:
+            # Consultar la caché antes de decodificar la imagen o cargar el modelo
+            batch['cache_keys'][index] = caption_cache_key(image_path, model_name, keyword, min_words, consistency_mode)
+            cached = None if refresh_cache else caption_cache_get(batch['cache_keys'][index])
+            if cached is not None:
+                batch['captions'][index] = cached
+                continue
+            
+            with stage_timer(model_name, 'decode', [indices[index]]):
+                batch['images'].append(load_caption_image(image_path, model_name))
+            batch['image_keys'].append(compute_file_hash(image_path))
+            batch['indices'].append(indices[index])
+            batch['positions'].append(index)
+        except Exception as e:
+            batch['captions'][index] = f"Error procesando imagen: {str(e)}"
+    
+    # Preprocesar solo si el procesador ya está cargado (si no, lo hará encode_images)
+    if batch['images'] and processors.get(model_name) is not None:
+        try:
+            with stage_timer(model_name, 'preprocess', batch['indices']):
+                batch['pixel_values'] = preprocess_images(model_name, batch['images'])
+        except Exception as e:
+            print(f"⚠️ Error preprocesando el lote en la precarga: {e}")
+    
+    return batch
+
+def generate_captions_batch(image_paths, model_name='blip', keyword='', min_words=0, consistency_mode='auto', refresh_cache=False):
+    """Generar captions para un lote de imágenes con BLIP/BLIP-2 (una llamada a generate() por lote)"""
+    batch = prepare_caption_batch(image_paths, model_name, keyword, min_words, consistency_mode, refresh_cache)
+    return run_caption_batch(batch, model_name, keyword, min_words, consistency_mode)
+
+def run_caption_batch(batch, model_name='blip', keyword='', min_words=0, consistency_mode='auto'):
+    """Etapa del modelo: generar los captions de un lote ya preparado con prepare_caption_batch()"""
+    captions = batch['captions']
+    cache_keys = batch['cache_keys']
+    images = batch['images']
+    image_keys = batch['image_keys']
+    indices = batch['indices']
+    positions = batch['positions']
+    pixel_values = batch['pixel_values']
+    
+    if not images:
+        return captions
+    
+    try:
+        # Obtener un lease sobre el modelo (se carga bajo demanda si no está en memoria)
+        with model_lease(model_name) as model_ready:
+            if not model_ready:
+                for index in positions:
+                    captions[index] = f"Error: No se pudo cargar el modelo {model_name}"
+                return captions
+            
+            if model_name == 'blip' and models.get('blip') is not None:
+                batch_fn = generate_captions_blip_batch
+            elif model_name == 'blip2' and models.get('blip2') is not None:
+                batch_fn = generate_captions_blip2_batch
+            else:
+                for index in positions:
+                    captions[index] = f"Modelo {model_name} no disponible"
+                return captions
+            
+            # Generar todo el lote y aplicar consistencia, keyword y límites de palabras
+            batch_captions = []
+            retry_indices = []
+            failed = set()
+            with stage_timer(model_name, 'generate', indices):
+                raw_captions = batch_fn(images, min_words, image_keys, pixel_values)
+            postprocess_started_at = time.time()
+            postprocess_start = time.perf_counter()
+            failed.update(i for i, caption in enumerate(raw_captions) if is_error_caption(caption))
+            for i, caption in enumerate(finalize_captions(raw_captions, keyword, consistency_mode)):
+                limited = apply_word_limits(caption, min_words)
+            
+                # Si apply_word_limits devuelve None, el caption es muy corto y se regenera
+                # (con varios candidatos ya se eligió el mejor: una sola llamada al modelo por imagen)
+                if limited is None:
+                    if get_caption_candidates() > 1:
+                        limited = caption.strip()
+                    else:
+                        retry_indices.append(i)
+                batch_captions.append(limited)
+            
+            observe_stage(model_name, 'postprocess', postprocess_started_at, time.perf_counter() - postprocess_start, indices)
+            
+            # Regenerar en un único lote los captions demasiado cortos
+            if retry_indices:
+                retry_pixel_values = pixel_values[retry_indices] if pixel_values is not None else None
+                with stage_timer(model_name, 'generate', [indices[i] for i in retry_indices]):
+                    regenerated = batch_fn([images[i] for i in retry_indices], min_words, [image_keys[i] for i in retry_indices], retry_pixel_values)
+                for i, raw_caption, caption in zip(retry_indices, regenerated, finalize_captions(regenerated, keyword, consistency_mode)):
+                    if is_error_caption(raw_caption):
+                        failed.add(i)
+                    else:
+                        failed.discard(i)
+                    batch_captions[i] = caption
+            
+            for i, (index, caption) in enumerate(zip(positions, batch_captions)):
+                captions[index] = caption
+                # Los errores no se guardan en la caché
+                if i not in failed:
+                    caption_cache_put(cache_keys[index], caption)
+            
+    except Exception as e:
+        for index in positions:
+            captions[index] = f"Error procesando imagen: {str(e)}"
+    
+    return captions
+
+def generate_caption(image_path, model_name='blip', keyword='', min_words=0, consistency_mode='auto', custom_prompt='', refresh_cache=False):
+    """Generar caption para una imagen (refresh_cache=True ignora la caché y guarda el nuevo caption)"""
+    # BLIP/BLIP2 comparten la ruta por lotes (lote de una sola imagen)
+    if model_name in ['blip', 'blip2']:
+        return generate_captions_batch([image_path], model_name, keyword, min_words, consistency_mode, refresh_cache)[0]
+    
+    try:
+        # Consultar la caché antes de decodificar la imagen o llamar a la API
+        cache_key = caption_cache_key(image_path, model_name, keyword, min_words, consistency_mode, custom_prompt)
+        cached = None if refresh_cache else caption_cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
+        # Cargar imagen (reducida al tamaño que necesita el modelo)
+        with stage_timer(model_name, 'decode'):
+            image = load_caption_image(image_path, model_name)
+        
+        # Generar caption según el modelo
+        # Modelos WD14 eliminados
+        if model_name == 'llama-vision':
+            # Para Llama Vision, usar prompt personalizado o uno por defecto
+            prompt = custom_prompt if custom_prompt else "Describe this image in detail."
+            caption = generate_caption_llama_vision(image, prompt)
+        else:
+            return f"Modelo {model_name} no disponible"
+        
+        # Aplicar reglas de consistencia y keyword
+        failed = is_error_caption(caption)
+        with stage_timer(model_name, 'postprocess'):
+            caption = finalize_caption(caption, keyword, consistency_mode)
+        
+        # Para Llama Vision y otros modelos, usar el caption tal como viene
+        caption = caption.strip()
+        if not failed:
+            caption_cache_put(cache_key, caption)
+        return caption
+            
+    except Exception as e:
+        return f"Error procesando imagen: {str(e)}"
+
+# Términos de personas detectables (se normalizan al término objetivo)
+PERSON_TERMS = (
+    # Términos femeninos
+    'girl', 'little girl', 'young girl', 'teenage girl', 'teen girl', 'female', 'lady', 'woman',
+    # Términos masculinos
+    'boy', 'little boy', 'young boy', 'teenage boy', 'teen boy', 'male', 'gentleman', 'man',
+    # Términos neutros/plurales
+    'people', 'person', 'persons', 'individual', 'child', 'children', 'kids', 'kid',
+)
+
+# Términos que pueden forzarse como modo de consistencia, en orden de prioridad para el modo automático
+CONSISTENCY_TARGET_TERMS = ('little girl', 'young girl', 'girl', 'woman', 'boy', 'man', 'person')
+
+# Patrón compilado una sola vez: una alternancia con los términos más largos primero, delimitada por espacios,
+# equivale a la búsqueda palabra a palabra de 3, 2 y 1 palabras. Con el grupo de captura, split() devuelve
+# en una sola pasada el texto intermedio (posiciones pares) y los términos encontrados (posiciones impares)
+PERSON_TERMS_PATTERN = re.compile(
+    r'(?<!\S)(' + '|'.join(re.escape(term) for term in sorted(PERSON_TERMS, key=lambda term: -len(term.split()))) + r')(?!\S)'
+)
+
+def split_person_terms(caption):
+    """Normalizar espacios y mayúsculas y separar el caption en texto y términos de personas (una pasada)"""
+    return PERSON_TERMS_PATTERN.split(' '.join(caption.lower().split()))
+
+def pick_target_term(found_terms):
+    """Elegir el término predominante entre los encontrados (femeninos específicos primero)"""
+    for term in CONSISTENCY_TARGET_TERMS:
+        if term in found_terms:
+            return term
+    return 'person'  # Por defecto si no se detecta nada
+
+def apply_consistency_rules(caption, consistency_mode='auto'):
+    """Aplicar reglas de consistencia para términos de personas"""
+    if consistency_mode == 'none':
+        return caption
+    
+    parts = split_person_terms(caption)
+    if len(parts) == 1:
+        return parts[0]
+    
+    # Si el modo es específico, usar ese término exacto; en automático, detectar el término predominante
+    if consistency_mode in CONSISTENCY_TARGET_TERMS:
+        target_term = consistency_mode
+    else:
+        target_term = pick_target_term(parts[1::2])
+    
+    parts[1::2] = [target_term] * (len(parts) // 2)
+    return ''.join(parts)
+
+def apply_consistency_rules_batch(captions, consistency_mode='auto'):
+    """Aplicar reglas de consistencia a una lista de captions"""
+    if consistency_mode == 'none':
+        return list(captions)
+    return [apply_consistency_rules(caption, consistency_mode) for caption in captions]
+
+def detect_predominant_person_term(caption, person_terms=None):
+    """Detectar el término de persona predominante en el caption"""
+    return pick_target_term(split_person_terms(caption)[1::2])
+
+def apply_word_limits(caption, min_words=0):
+    """Aplicar límites de palabras al caption"""
+    words = caption.strip().split()
+    word_count = len(words)
+    
+    # Si no se especifican límites, usar valores por defecto
+    if min_words == 0:
+        min_words = 15  # Mínimo por defecto: 15 palabras
+    
+    # Si el caption es muy corto, intentar regenerar con parámetros más largos
+    if word_count < min_words:
+        # Para captions muy cortos, intentar regenerar con max_length más alto
+        return None  # Indicar que se necesita regenerar
     
     return caption.strip()
 
-def clean_blip2_caption(caption):
-    """Limpiar caption de BLIP-2 - Versión conservadora para preservar consistencia"""
-    import re
+# Caché LRU en memoria de las salidas del codificador de visión (por imagen y modelo):
+# los reintentos y regeneraciones solo pagan la decodificación de texto
+encoder_cache = OrderedDict()  # (modelo, hash de la imagen) -> tensor (1, tokens, dim)
+encoder_cache_bytes = 0
+encoder_cache_lock = threading.Lock()
+encoder_cache_counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def get_encoder_cache_config():
+    """Obtener configuración de la caché del codificador de visión desde config.json"""
+    cache_config = CONFIG.get("encoder_cache", {})
+    return {
+        'enabled': bool(cache_config.get("enabled", True)),
+        'max_size_mb': float(cache_config.get("max_size_mb", 256))
+    }
+
+def encoder_cache_get(key):
+    """Buscar la salida del codificador de una imagen; None si no está"""
+    with encoder_cache_lock:
+        embeds = encoder_cache.get(key)
+        if embeds is None:
+            encoder_cache_counters['misses'] += 1
+            return None
+        encoder_cache.move_to_end(key)
+        encoder_cache_counters['hits'] += 1
+        return embeds
+
+def encoder_cache_put(key, embeds):
+    """Guardar la salida del codificador de una imagen, expulsando las menos usadas si se supera el límite"""
+    global encoder_cache_bytes
+    
+    max_bytes = get_encoder_cache_config()['max_size_mb'] * 1024 * 1024
+    size = embeds.element_size() * embeds.nelement()
+    if size > max_bytes:
+        return
+    
+    with encoder_cache_lock:
+        previous = encoder_cache.pop(key, None)
+        if previous is not None:
+            encoder_cache_bytes -= previous.element_size() * previous.nelement()
+        encoder_cache[key] = embeds
+        encoder_cache_bytes += size
+        while encoder_cache_bytes > max_bytes:
+            _, evicted = encoder_cache.popitem(last=False)
+            encoder_cache_bytes -= evicted.element_size() * evicted.nelement()
+            encoder_cache_counters['evictions'] += 1
+
+def clear_encoder_cache(model_name=None):
+    """Vaciar la caché del codificador (solo las entradas de un modelo si se indica)"""
+    global encoder_cache_bytes
     
-    # Eliminar precios (ej: $44 - $45, $100, etc.)
-    caption = re.sub(r'\$\d+(?:\.\d+)?(?:\s*-\s*\$\d+(?:\.\d+)?)?', '', caption)
+    with encoder_cache_lock:
+        for key in [key for key in encoder_cache if model_name is None or key[0] == model_name]:
+            evicted = encoder_cache.pop(key)
+            encoder_cache_bytes -= evicted.element_size() * evicted.nelement()
+
+def get_encoder_cache_stats():
+    """Estadísticas de la caché del codificador de visión"""
+    with encoder_cache_lock:
+        return {
+            **get_encoder_cache_config(),
+            'entries': len(encoder_cache),
+            'size_mb': round(encoder_cache_bytes / (1024 * 1024), 2),
+            **encoder_cache_counters
+        }
+
+def preprocess_images(model_name, images):
+    """Ejecutar el procesador del modelo sobre imágenes PIL; devuelve pixel_values en CPU"""
+    return processors[model_name](images=images, return_tensors="pt")['pixel_values']
+
+def encode_images(model_name, images, image_keys=None, pixel_values=None):
+    """Salida del codificador de visión para un lote (BLIP: image embeds, BLIP-2: salida del Q-Former proyectada)
+
+    Las imágenes con clave ya codificadas se toman de la caché; el resto se procesa en un único lote.
+    pixel_values (opcional) son los píxeles ya preprocesados de todas las imágenes, en el mismo orden.
+    """
+    import torch
+    
+    use_cache = image_keys is not None and get_encoder_cache_config()['enabled']
+    keys = [(model_name, key) if use_cache and key else None for key in (image_keys or [None] * len(images))]
+    embeds = [encoder_cache_get(key) if key else None for key in keys]
+    
+    missing = [i for i, cached in enumerate(embeds) if cached is None]
+    if missing:
+        # Los píxeles pueden venir ya preprocesados por el pipeline de precarga
+        if pixel_values is None:
+            pixel_values = preprocess_images(model_name, [images[i] for i in missing])
+        else:
+            pixel_values = pixel_values[missing]
+        pixel_values = pixel_values.to(get_device())
+        model = models[model_name]
+        with torch.no_grad():
+            if isinstance(model, OnnxBlipCaptioner):
+                encoded = torch.from_numpy(model.encode(pixel_values.cpu().numpy()))
+            elif model_name == 'blip':
+                encoded = model.vision_model(pixel_values=pixel_values)[0]
+            else:
+                image_embeds = model.vision_model(pixel_values, return_dict=True).last_hidden_state
+                image_attention_mask = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
+                query_tokens = model.query_tokens.expand(image_embeds.shape[0], -1, -1)
+                query_output = model.qformer(
+                    query_embeds=query_tokens,
+                    encoder_hidden_states=image_embeds,
+                    encoder_attention_mask=image_attention_mask,
+                    return_dict=True
+                ).last_hidden_state
+                # El Q-Former se mantiene en fp32; volver al tipo del modelo
+                encoded = model.language_projection(query_output.to(image_embeds.dtype))
+        
+        for position, i in enumerate(missing):
+            embeds[i] = encoded[position:position + 1]
+            if keys[i]:
+                # Copia propia: una vista mantendría viva la memoria de todo el lote y el límite de la caché no la contaría
+                embeds[i] = embeds[i].clone()
+                encoder_cache_put(keys[i], embeds[i])
+    
+    return torch.cat(embeds)
+
+def decode_blip(image_embeds, **generate_kwargs):
+    """Generar tokens con el decodificador de texto de BLIP a partir de image embeds ya calculados"""
+    import torch
     
-    # Eliminar referencias a ciudades/países específicos
-    cities_countries = [
+    model = models['blip']
+    if isinstance(model, OnnxBlipCaptioner):
+        return torch.from_numpy(model.generate(image_embeds.cpu().numpy(), **generate_kwargs))
+    
+    image_attention_mask = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
+    input_ids = torch.LongTensor([[model.config.text_config.bos_token_id]]).repeat(image_embeds.shape[0], 1).to(image_embeds.device)
+    with torch.no_grad():
+        return model.text_decoder.generate(
+            input_ids=input_ids,
+            eos_token_id=model.config.text_config.sep_token_id,
+            pad_token_id=model.config.text_config.pad_token_id,
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=image_attention_mask,
+            **generate_kwargs
+        )
+
+def decode_blip2(language_model_inputs, **generate_kwargs):
+    """Generar tokens con el modelo de lenguaje de BLIP-2 a partir de la salida del Q-Former ya proyectada"""
+    import torch
+    
+    model = models['blip2']
+    if hasattr(model, "hf_device_map"):
+        # Preparar los hooks de accelerate como hace Blip2ForConditionalGeneration.generate()
+        model._preprocess_accelerate()
+    
+    embeddings = model.get_input_embeddings()
+    start_tokens = [model.config.image_token_index] * model.config.num_query_tokens + [model.config.text_config.bos_token_id]
+    input_ids = torch.tensor([start_tokens], dtype=torch.long, device=embeddings.weight.device).repeat(language_model_inputs.shape[0], 1)
+    with torch.no_grad():
+        inputs_embeds = embeddings(input_ids)
+        special_image_mask = (input_ids == model.config.image_token_id).unsqueeze(-1).expand_as(inputs_embeds)
+        inputs_embeds = inputs_embeds.masked_scatter(special_image_mask, language_model_inputs.to(inputs_embeds.device, inputs_embeds.dtype))
+        
+        inputs = {'inputs_embeds': inputs_embeds, 'attention_mask': torch.ones_like(input_ids)}
+        if not model.language_model.config.is_encoder_decoder:
+            inputs['input_ids'] = input_ids
+        return model.language_model.generate(**inputs, **generate_kwargs)
+
+def generate_caption_blip(image, min_words=0):
+    """Generar caption con BLIP"""
+    return generate_captions_blip_batch([image], min_words)[0]
+
+def generate_captions_blip_batch(images, min_words=0, image_keys=None, pixel_values=None):
+    """Generar captions con BLIP para un lote de imágenes en una sola llamada a generate()
+
+    image_keys (hash de contenido por imagen) activa la caché del codificador de visión;
+    pixel_values (del pipeline de precarga) evita volver a ejecutar el procesador.
+    """
+    try:
+        # Si no se especifican límites, usar valores por defecto
+        if min_words == 0:
+            min_words = 15  # Mínimo por defecto: 15 palabras
+        
+        # Calcular max_length basado en las palabras mínimas (margen amplio para llegar al mínimo)
+        max_length = int(int(max(min_words * 3, 50) * 1.5) * 2)
+        
+        # Parámetros creativos para generar más palabras - SIEMPRE con aleatoriedad
+        num_candidates = get_caption_candidates()
+        num_beams = max(3, num_candidates)
+        temperature = 1.6
+        
+        # Codificar el lote (o tomarlo de la caché) y generar solo el texto
+        image_embeds = encode_images('blip', list(images), image_keys, pixel_values)
+        
+        # Calcular min_length en tokens (aproximadamente 1.3 tokens por palabra)
+        min_length_tokens = max(int(min_words * 1.3), 10)
+        
+        out = decode_blip(
+            image_embeds,
+            max_length=max_length,
+            min_length=min_length_tokens,  # min_length en tokens, no palabras
+            num_beams=num_beams,
+            **get_sampling_kwargs(temperature),  # Muestreo aleatorio salvo generación determinista
+            num_return_sequences=num_candidates,  # Varios candidatos por imagen en la misma llamada
+            early_stopping=True,  # Activar para BLIP
+            repetition_penalty=1.2,  # Evitar repeticiones
+            no_repeat_ngram_size=3   # Evitar n-gramas repetidos
+        )
+        
+        # Limpiar repeticiones excesivas y quedarse con un caption por imagen
+        decoded = processors['blip'].batch_decode(out, skip_special_tokens=True)
+        with stage_timer('blip', 'cleanup', []):
+            captions = clean_blip_captions(decoded)
+        return select_caption_candidates(captions, num_candidates, min_words)
+        
+    except Exception as e:
+        return [f"Error con BLIP: {str(e)}"] * len(images)
+
+# Listas de limpieza por defecto (configurables en config.json -> caption_cleaning)
+CAPTION_CLEANING_DEFAULTS = {
+    # Referencias a ciudades/países específicos
+    'cities_countries': [
         'marysville', 'canada', 'france', 'paris', 'london', 'new york', 'tokyo',
         'berlin', 'madrid', 'rome', 'barcelona', 'milan', 'amsterdam', 'vienna',
         'italy', 'spain', 'germany', 'japan', 'china', 'korea', 'mexico', 'brazil'
-    ]
-    for place in cities_countries:
-        caption = re.sub(rf'\b{place}\b', '', caption, flags=re.IGNORECASE)
-    
-    # Eliminar texto en francés común
-    french_phrases = [
+    ],
+    # Texto en francés común
+    'french_phrases': [
         'portait une', 'vidienne', 'curle', 'boux', 'tinglers', 'cheveux', 'pantalle', 'romanes',
         'photo', 'une femme', 'jeune fille', 'avec', 'dans', 'sur', 'pour', 'avec les',
         'et une', 'les cheveux', 'romanes photo', 'une vidienne', 'curle boux'
-    ]
-    for phrase in french_phrases:
-        caption = re.sub(rf'\b{phrase}\b', '', caption, flags=re.IGNORECASE)
-    
-    # Eliminar referencias a marcas/productos específicos
-    brands_products = [
+    ],
+    # Marcas/productos específicos
+    'brands_products': [
         'lillyhilfshsockwear', 'thermal compression', 'leggings', 'bernies 2018',
         'laurice bergmetscher', 'nelis marica', 'gr 1 4 class', 'project bernies',
         'apple tree', 'design challenge', 'annual girls', 'class project'
-    ]
-    for item in brands_products:
-        caption = re.sub(rf'\b{re.escape(item)}\b', '', caption, flags=re.IGNORECASE)
-    
-    # Eliminar números de teléfono, códigos postales, etc.
-    caption = re.sub(r'\b\d{3,}\b', '', caption)  # Números largos
-    
-    # Eliminar objetos alucinados comunes
-    hallucinated_objects = [
+    ],
+    # Objetos alucinados comunes
+    'hallucinated_objects': [
         'toothbrush', 'knife', 'sword', 'gun', 'weapon', 'tool', 'instrument',
         'device', 'machine', 'equipment', 'apparatus', 'gadget'
-    ]
-    for obj in hallucinated_objects:
-        caption = re.sub(rf'\b{obj}\b', '', caption, flags=re.IGNORECASE)
-    
-    # Eliminar repeticiones excesivas (similar a BLIP)
-    caption = re.sub(r'\b(\w+)\s+\1\s+\1\b', r'\1', caption)  # Palabras repetidas 3+ veces
-    caption = re.sub(r'\b(\w+)\s+\1\b', r'\1', caption)  # Palabras repetidas 2 veces
+    ],
+    # Términos adicionales a eliminar
+    'extra_terms': []
+}
+
+# Patrones fijos compilados al importar el módulo
+CLEAN_REPEATED_3_PATTERN = re.compile(r'\b(\w+)\s+\1\s+\1\b')  # Palabras repetidas 3+ veces
+CLEAN_REPEATED_2_PATTERN = re.compile(r'\b(\w+)\s+\1\b')  # Palabras repetidas 2 veces
+CLEAN_HAND_PATTERN = re.compile(r'\b(her right hand|her left hand|her hand)\s+(on|in|with)\s+(her right hand|her left hand|her hand)\b', re.IGNORECASE)
+CLEAN_ARTICLES_PATTERN = re.compile(r'\b(the|a|an|and|in|on|at|to|of|with|for)\s+\1\b', re.IGNORECASE)
+CLEAN_SPACES_PATTERN = re.compile(r'\s+')
+CLEAN_CHARS_PATTERN = re.compile(r'[^\w\s.,!?-]')
+
+# Precios (ej: $44 - $45, $100) y números largos (teléfonos, códigos postales...)
+CLEAN_PRICE_REGEX = r'\$\d+(?:\.\d+)?(?:\s*-\s*\$\d+(?:\.\d+)?)?'
+CLEAN_NUMBER_REGEX = r'\b\d{3,}\b'
+
+caption_cleaning_pattern = None
+caption_cleaning_signature = ''
+
+def get_caption_cleaning_config():
+    """Obtener las listas de limpieza de BLIP-2 (config.json sobrescribe cada lista por defecto)"""
+    cleaning_config = CONFIG.get("caption_cleaning", {})
+    return {name: [str(term) for term in cleaning_config.get(name, default) if str(term).strip()]
+            for name, default in CAPTION_CLEANING_DEFAULTS.items()}
+
+def compile_caption_cleaning():
+    """Compilar todas las listas de limpieza en una única alternancia (se llama al importar y al guardar la configuración)"""
+    global caption_cleaning_pattern, caption_cleaning_signature
     
-    # Eliminar frases repetitivas específicas
-    caption = re.sub(r'\b(her right hand|her left hand|her hand)\s+(on|in|with)\s+(her right hand|her left hand|her hand)\b', 'her hand', caption, flags=re.IGNORECASE)
+    word_lists = get_caption_cleaning_config()
+    terms = {term.lower(): None for terms in word_lists.values() for term in terms}
+    # Los términos más largos primero, para eliminar frases completas ('avec les') antes que sus palabras ('avec')
+    alternation = '|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True))
     
-    # Eliminar repeticiones de artículos y preposiciones (similar a BLIP)
-    caption = re.sub(r'\b(the|a|an|and|in|on|at|to|of|with|for)\s+\1\b', r'\1', caption, flags=re.IGNORECASE)
+    # Los precios van primero para que '$100' no deje el '$' al eliminar el número
+    alternatives = [CLEAN_PRICE_REGEX]
+    if alternation:
+        alternatives.append(rf'\b(?:{alternation})\b')
+    alternatives.append(CLEAN_NUMBER_REGEX)
+    caption_cleaning_pattern = re.compile('|'.join(alternatives), re.IGNORECASE)
+    caption_cleaning_signature = hashlib.sha256(json.dumps(word_lists, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def remove_repetitions(caption):
+    """Eliminar repeticiones de palabras, frases de manos y artículos y normalizar espacios"""
+    caption = CLEAN_REPEATED_3_PATTERN.sub(r'\1', caption)
+    caption = CLEAN_REPEATED_2_PATTERN.sub(r'\1', caption)
+    caption = CLEAN_HAND_PATTERN.sub('her hand', caption)
+    caption = CLEAN_ARTICLES_PATTERN.sub(r'\1', caption)
+    return CLEAN_SPACES_PATTERN.sub(' ', caption)
+
+def clean_blip_caption(caption):
+    """Limpiar caption de BLIP de repeticiones excesivas"""
+    return remove_repetitions(caption).strip()
+
+def clean_blip_captions(captions):
+    """Limpiar una lista de captions de BLIP"""
+    return [clean_blip_caption(caption) for caption in captions]
+
+def clean_blip2_caption(caption):
+    """Limpiar caption de BLIP-2 - Versión conservadora para preservar consistencia"""
+    # Eliminar precios, lugares, texto en francés, marcas, números largos y objetos alucinados en una pasada
+    caption = caption_cleaning_pattern.sub('', caption)
     
-    # Limpiar espacios múltiples
-    caption = re.sub(r'\s+', ' ', caption)
+    # Eliminar repeticiones excesivas (similar a BLIP) y limpiar espacios múltiples
+    caption = remove_repetitions(caption)
     
     # Limpiar caracteres extraños
-    caption = re.sub(r'[^\w\s.,!?-]', '', caption)
+    caption = CLEAN_CHARS_PATTERN.sub('', caption)
     
     # NO eliminar palabras comunes como en la versión anterior
     # Esto preserva la estructura del caption para la consistencia
     
     return caption.strip()
 
+def clean_blip2_captions(captions):
+    """Limpiar una lista de captions de BLIP-2"""
+    return [clean_blip2_caption(caption) for caption in captions]
+
+compile_caption_cleaning()
+
 def generate_caption_blip2(image, min_words=0):
     """Generar caption con BLIP-2 - Instalación limpia"""
+    return generate_captions_blip2_batch([image], min_words)[0]
+
+def generate_captions_blip2_batch(images, min_words=0, image_keys=None, pixel_values=None):
+    """Generar captions con BLIP-2 para un lote de imágenes en una sola llamada a generate()
+
+    image_keys (hash de contenido por imagen) activa la caché del codificador de visión;
+    pixel_values (del pipeline de precarga) evita volver a ejecutar el procesador.
+    """
     try:
         # Si no se especifican límites, usar valores por defecto
         if min_words == 0:
@@ -1145,48 +2880,75 @@ def generate_caption_blip2(image, min_words=0):
         max_length = max(min_words * 2, 50)  # Longitud máxima
         min_length_tokens = max(int(min_words * 1.3), 10)  # Mínimo en tokens
         
-        # Generación con aleatoriedad para regeneración
-        inputs = processors['blip2'](image, return_tensors="pt").to(device)
-        out = models['blip2'].generate(
-            **inputs, 
+        # Con varios candidatos por imagen no hay segundo intento: se elige entre ellos
+        num_candidates = min(get_caption_candidates(), 7)
+        
+        # Codificar el lote (o tomarlo de la caché); la generación con aleatoriedad solo decodifica texto
+        language_model_inputs = encode_images('blip2', list(images), image_keys, pixel_values)
+        out = decode_blip2(
+            language_model_inputs,
             max_length=max_length,
             min_length=min_length_tokens,
             num_beams=7,
-            temperature=1.1,  # Aumentar temperatura para aleatoriedad
-            do_sample=True,   # SIEMPRE usar muestreo para aleatoriedad
+            **get_sampling_kwargs(1.1),  # Temperatura 1.1 para aleatoriedad salvo generación determinista
+            num_return_sequences=num_candidates,
             early_stopping=True,
             repetition_penalty=1.2,
             no_repeat_ngram_size=3
         )
-        caption = processors['blip2'].decode(out[0], skip_special_tokens=True)
         
         # Limpieza básica
-        caption = clean_blip2_caption(caption)
-        
-        # Verificar si cumple el mínimo de palabras
-        word_count = len(caption.strip().split())
-        if word_count >= min_words:
-            return caption
-        else:
-            # Si no cumple, intentar una vez más con parámetros más largos
+        decoded = processors['blip2'].batch_decode(out, skip_special_tokens=True)
+        with stage_timer('blip2', 'cleanup', []):
+            captions = clean_blip2_captions(decoded)
+        captions = select_caption_candidates(captions, num_candidates, min_words)
+        
+        # Verificar qué captions no cumplen el mínimo de palabras
+        short_indices = [i for i, caption in enumerate(captions) if len(caption.strip().split()) < min_words]
+        if short_indices and num_candidates == 1:
+            # Si no cumplen, intentar una vez más con parámetros más largos solo para esas imágenes
             max_length = max(min_words * 3, 75)
-            out = models['blip2'].generate(
-                **inputs, 
+            out = decode_blip2(
+                language_model_inputs[short_indices],
                 max_length=max_length,
                 min_length=min_length_tokens,
                 num_beams=5,
-                temperature=1.3,  # Más aleatoriedad en el segundo intento
-                do_sample=True,
+                **get_sampling_kwargs(1.3),  # Más aleatoriedad en el segundo intento
                 early_stopping=True,
                 repetition_penalty=1.2,
                 no_repeat_ngram_size=3
             )
-            caption = processors['blip2'].decode(out[0], skip_special_tokens=True)
-            caption = clean_blip2_caption(caption)
-            return caption
+            decoded = processors['blip2'].batch_decode(out, skip_special_tokens=True)
+            with stage_timer('blip2', 'cleanup', []):
+                retried = clean_blip2_captions(decoded)
+            for i, caption in zip(short_indices, retried):
+                captions[i] = caption
+        
+        return captions
         
     except Exception as e:
-        return f"Error con BLIP-2: {str(e)}"
+        return [f"Error con BLIP-2: {str(e)}"] * len(images)
+
+# Sesión HTTP compartida para OpenRouter (pool de conexiones keep-alive)
+openrouter_session = None
+openrouter_session_lock = threading.Lock()
+
+def get_remote_concurrency():
+    """Obtener el número máximo de peticiones concurrentes a la API remota desde config.json"""
+    return max(1, int(CONFIG.get("settings", {}).get("remote_concurrency", 4)))
+
+def get_openrouter_session():
+    """Obtener (creándola una sola vez) la sesión HTTP compartida para OpenRouter"""
+    global openrouter_session
+    
+    with openrouter_session_lock:
+        if openrouter_session is None:
+            pool_size = get_remote_concurrency()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            openrouter_session = requests.Session()
+            openrouter_session.mount('https://', adapter)
+            openrouter_session.mount('http://', adapter)
+        return openrouter_session
 
 def generate_caption_llama_vision(image, custom_prompt="Describe this image in detail."):
     """Generar caption con Llama 3.2 Vision via OpenRouter.ai"""
@@ -1223,7 +2985,7 @@ def generate_caption_llama_vision(image, custom_prompt="Describe this image in d
                 }
             ],
             "max_tokens": 200,
-            "temperature": 0.7
+            "temperature": 0 if is_deterministic_generation() else 0.7
         }
         
         # Enviar petición
@@ -1232,12 +2994,19 @@ def generate_caption_llama_vision(image, custom_prompt="Describe this image in d
             "Content-Type": "application/json"
         }
         
-        response = requests.post(
-            CONFIG["endpoints"]["openrouter_url"],
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        # Sesión compartida con keep-alive: reutiliza conexiones entre imágenes y peticiones concurrentes
+        try:
+            with stage_timer('llama-vision', 'remote_api'):
+                response = get_openrouter_session().post(
+                    CONFIG["endpoints"]["openrouter_url"],
+                    headers=headers,
+                    json=payload,
+                    timeout=30
+                )
+        except requests.RequestException:
+            metrics_inc('captioning_openrouter_responses_total', status='error')
+            raise
+        metrics_inc('captioning_openrouter_responses_total', status=str(response.status_code))
         
         if response.status_code == 200:
             result = response.json()
@@ -1254,46 +3023,352 @@ def generate_caption_llama_vision(image, custom_prompt="Describe this image in d
 
 # Función generate_wd14_tags eliminada (WD14 removido)
 
-def process_images_async(files, model_name, task_id, keyword='', min_words=0, consistency_mode='auto', custom_prompt=''):
-    """Procesar imágenes de forma asíncrona"""
+def get_pipeline_config():
+    """Obtener configuración del pipeline de precarga (decodificación y preprocesado) desde config.json"""
+    pipeline_config = CONFIG.get("pipeline", {})
+    return {
+        # Imágenes preparadas por delante del lote que está generando el modelo (0 = sin precarga)
+        'prefetch_images': max(0, int(pipeline_config.get("prefetch_images", 8))),
+        'workers': max(1, int(pipeline_config.get("workers", 2)))
+    }
+
+def update_prefetch_status(task_id, pending, depth):
+    """Publicar en el estado de la tarea la ocupación de la cola de precarga"""
+    if not task_id or task_id not in progress_data:
+        return
+    progress_data[task_id]['prefetch'] = {
+        'depth': depth,
+        'queued': sum(len(paths) for paths, _, _ in pending),
+        'ready': sum(len(paths) for paths, _, future in pending if future.done())
+    }
+
+def iter_captions_batched(file_paths, model_name, keyword='', min_words=0, consistency_mode='auto', custom_prompt='', task_id=None):
+    """Generar captions por lotes (BLIP/BLIP2); devuelve un caption por ruta, None si el archivo no existe
+
+    Mientras el modelo genera un lote, un pool de hilos decodifica y preprocesa los siguientes
+    en una cola acotada a pipeline.prefetch_images imágenes.
+    """
+    if model_name not in LOCAL_MODELS:
+        for path in file_paths:
+            yield generate_caption(path, model_name, keyword, min_words, consistency_mode, custom_prompt) if os.path.exists(path) else None
+        return
+    
+    batch_size = get_caption_batch_size()
+    config = get_pipeline_config()
+    batches = [file_paths[start:start + batch_size] for start in range(0, len(file_paths), batch_size)]
+    pending = deque()  # (rutas existentes, existe por ruta, future de prepare_caption_batch) en orden
+    executor = ThreadPoolExecutor(max_workers=config['workers'], thread_name_prefix='caption-prefetch')
+    
+    def submit(batch_index):
+        batch_paths = batches[batch_index]
+        exists = [os.path.exists(path) for path in batch_paths]
+        existing_paths = [path for path, found in zip(batch_paths, exists) if found]
+        indices = [batch_index * batch_size + i for i, found in enumerate(exists) if found]
+        future = executor.submit(contextvars.copy_context().run, prepare_caption_batch, existing_paths, model_name, keyword, min_words, consistency_mode, False, indices)
+        pending.append((existing_paths, exists, future))
+    
+    model_acquired = False
     try:
-        # Cargar modelo bajo demanda con task_id para mostrar progreso
-        if not load_model_on_demand(model_name, task_id):
-            progress_data[task_id]['status'] = 'error'
-            progress_data[task_id]['message'] = f'Error: No se pudo cargar el modelo {model_name}'
-            return
-        
-        for i, filename in enumerate(files):
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        next_batch = 0
+        for _ in batches:
+            if not pending:
+                submit(next_batch)
+                next_batch += 1
+            _, exists, future = pending.popleft()
             
-            if os.path.exists(file_path):
-                caption = generate_caption(file_path, model_name, keyword, min_words, consistency_mode, custom_prompt)
-                
+            # Rellenar la cola con los lotes siguientes mientras quepan en la profundidad configurada
+            while next_batch < len(batches) and sum(len(paths) for paths, _, _ in pending) + len(batches[next_batch]) <= config['prefetch_images']:
+                submit(next_batch)
+                next_batch += 1
+            update_prefetch_status(task_id, pending, config['prefetch_images'])
+            
+            # El modelo se carga con el primer lote que no está completo en la caché; el lease se mantiene
+            # hasta terminar la tarea para que no se descargue entre lotes
+            batch = future.result()
+            if batch['images'] and not model_acquired:
+                model_acquired = acquire_model(model_name, task_id)
+                if not model_acquired:
+                    raise RuntimeError(f'No se pudo cargar el modelo {model_name}')
+            
+            captions = iter(run_caption_batch(batch, model_name, keyword, min_words, consistency_mode))
+            for found in exists:
+                yield next(captions) if found else None
+        
+        update_prefetch_status(task_id, pending, config['prefetch_images'])
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if model_acquired:
+            release_model(model_name)
+
+def iter_captions_remote(file_paths, model_name, keyword='', min_words=0, consistency_mode='auto', custom_prompt=''):
+    """Generar captions con la API remota usando un pool acotado de hilos, devolviéndolos en el orden original"""
+    executor = ThreadPoolExecutor(max_workers=get_remote_concurrency(), thread_name_prefix='remote-caption')
+    try:
+        futures = [
+            executor.submit(contextvars.copy_context().run, run_for_image, index, generate_caption, path, model_name, keyword, min_words, consistency_mode, custom_prompt)
+            if os.path.exists(path) else None
+            for index, path in enumerate(file_paths)
+        ]
+        for future in futures:
+            yield future.result() if future is not None else None
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def process_images_async(files, model_name, task_id, keyword='', min_words=0, consistency_mode='auto', custom_prompt='', profile=False):
+    """Procesar imágenes de forma asíncrona (se ejecuta en un worker del planificador)
+
+    profile=True captura un perfil de torch de la generación en tracing.profile_dir. El modelo no se
+    carga hasta que un lote tiene imágenes que no están en la caché de captions.
+    """
+    profiler = None
+    captions = None
+    try:
+        # El trabajo sale de la cola
+        progress_data[task_id].update({'status': 'processing', 'message': '', 'queue_position': None,
+                                       'estimated_start': None, 'estimated_wait_seconds': None})
+        notify_task_update(task_id)
+        
+        # El perfil de torch solo tiene sentido con los modelos locales
+        if profile and model_name in LOCAL_MODELS:
+            profiler = start_task_profiler(task_id)
+        
+        # BLIP/BLIP2 procesan por lotes; Llama Vision con peticiones concurrentes
+        file_paths = [resolve_upload_path(entry['file_id']) for entry in files]
+        if model_name == 'llama-vision':
+            captions = iter_captions_remote(file_paths, model_name, keyword, min_words, consistency_mode, custom_prompt)
+        else:
+            captions = iter_captions_batched(file_paths, model_name, keyword, min_words, consistency_mode, custom_prompt, task_id)
+        
+        # Publicar resultados y progreso imagen a imagen, en el orden original
+        for i, (entry, caption) in enumerate(zip(files, captions)):
+            metrics_inc('captioning_images_total', model=model_name,
+                        result='missing' if caption is None else 'error' if is_error_caption(caption) else 'ok')
+            if caption is not None:
                 progress_data[task_id]['results'].append({
-                    'filename': filename,
+                    'filename': entry['filename'],
                     'caption': caption,
-                    'file_id': filename,  # Usar el nombre del archivo como ID
+                    'file_id': entry['file_id'],  # ID de contenido estable (o nombre en subidas antiguas)
                     'model_used': model_name
                 })
             
             # Actualizar progreso
             progress_data[task_id]['current'] = i + 1
             progress_data[task_id]['progress'] = int((i + 1) / len(files) * 100)
+            notify_task_update(task_id)
         
         # Completar tarea
+        save_task_profiler(task_id, profiler)
+        profiler = None
         progress_data[task_id]['status'] = 'completed'
-        
-        # Descargar modelo al finalizar la generación
-        print(f"🗑️ Finalizada la generación con {model_name}, descargando modelo...")
-        unload_model(model_name)
+        finish_task(task_id)
         
     except Exception as e:
+        save_task_profiler(task_id, profiler)
+        profiler = None
         progress_data[task_id]['status'] = 'error'
+        progress_data[task_id]['message'] = f'Error: {e}'
         progress_data[task_id]['error'] = str(e)
+        finish_task(task_id)
         
-        # Descargar modelo incluso si hay error
-        print(f"🗑️ Error en la generación con {model_name}, descargando modelo...")
-        unload_model(model_name)
+    finally:
+        # Cerrar el generador libera el lease del modelo incluso si hay error
+        if captions is not None:
+            captions.close()
+
+# Planificador de trabajos: pool acotado de workers, afinidad por modelo y carril prioritario interactivo
+JOB_PRIORITY_INTERACTIVE = 0  # Regeneraciones de una imagen (la petición HTTP espera el resultado)
+JOB_PRIORITY_BATCH = 1  # Tareas de /api/generate
+job_queue = []  # Trabajos en espera, en orden de llegada
+running_jobs = {}  # id -> trabajo en ejecución
+job_scheduler_condition = threading.Condition()
+job_workers = []
+model_seconds_per_image = {}  # modelo -> media móvil de segundos por imagen (para estimar la espera)
+
+def get_scheduler_config():
+    """Obtener configuración del planificador de trabajos desde config.json"""
+    scheduler_config = CONFIG.get("scheduler", {})
+    workers = max(1, int(scheduler_config.get("workers", 2)))
+    return {
+        'workers': workers,
+        # Workers reservados para el carril interactivo (al menos uno queda para las tareas por lotes)
+        'interactive_workers': min(max(0, int(scheduler_config.get("interactive_workers", 1))), workers - 1),
+        'max_queued_jobs': max(1, int(scheduler_config.get("max_queued_jobs", 100))),
+        # Tras esta espera un trabajo se despacha aunque su modelo no esté cargado (evita inanición)
+        'affinity_max_wait_seconds': float(scheduler_config.get("affinity_max_wait_seconds", 120)),
+        'interactive_timeout_seconds': float(scheduler_config.get("interactive_timeout_seconds", 300)),
+        'default_seconds_per_image': float(scheduler_config.get("default_seconds_per_image", 2.0))
+    }
+
+def start_job_workers():
+    """Arrancar (una sola vez) los workers del planificador"""
+    with job_scheduler_condition:
+        if job_workers:
+            return
+        for index in range(get_scheduler_config()['workers']):
+            worker = threading.Thread(target=job_worker_loop, name=f"job-worker-{index}", daemon=True)
+            worker.start()
+            job_workers.append(worker)
+
+def submit_job(fn, args=(), model_name='blip', images=1, priority=JOB_PRIORITY_BATCH, task_id=None, file_ids=()):
+    """Encolar un trabajo; devuelve un Future con su resultado, o None si la cola está llena
+
+    file_ids son las subidas que usa el trabajo: no se pueden eliminar mientras esté en cola o en ejecución.
+    """
+    start_job_workers()
+    with job_scheduler_condition:
+        if len(job_queue) >= get_scheduler_config()['max_queued_jobs']:
+            return None
+        job = {
+            'id': str(uuid.uuid4()),
+            'task_id': task_id,
+            'model': model_name,
+            'priority': priority,
+            'images': max(1, images),
+            'fn': fn,
+            'args': args,
+            'file_ids': set(file_ids),
+            'future': Future(),
+            'enqueued_at': time.time(),
+            'started_at': None
+        }
+        job_queue.append(job)
+        update_queue_estimates()
+        job_scheduler_condition.notify_all()
+        return job['future']
+
+def is_upload_in_use(file_id):
+    """Comprobar si algún trabajo en cola o en ejecución usa una subida; llamar con job_scheduler_condition"""
+    return any(file_id in job['file_ids'] for job in list(job_queue) + list(running_jobs.values()))
+
+def cancel_job(future):
+    """Retirar de la cola un trabajo que aún no ha empezado"""
+    with job_scheduler_condition:
+        if not future.cancel():
+            return False
+        job_queue[:] = [job for job in job_queue if job['future'] is not future]
+        update_queue_estimates()
+        return True
+
+def is_model_warm(model_name):
+    """Un modelo está 'caliente' si no hay que cargarlo: remoto, ya en memoria o usado por un trabajo en curso"""
+    if model_name not in LOCAL_MODELS:
+        return True
+    if model_loading_status.get(model_name, {}).get('loaded', False):
+        return True
+    return any(job['model'] == model_name for job in running_jobs.values())
+
+def order_queued_jobs(now=None):
+    """Orden de despacho de la cola: primero el carril interactivo y, dentro de cada carril,
+    los trabajos cuyo modelo ya está cargado (agrupando por modelo para no cargar y descargar en cada trabajo)"""
+    now = now or time.time()
+    max_wait = get_scheduler_config()['affinity_max_wait_seconds']
+    warm = {job['model'] for job in job_queue if is_model_warm(job['model'])}
+    
+    ordered = []
+    for priority in (JOB_PRIORITY_INTERACTIVE, JOB_PRIORITY_BATCH):
+        pending = [job for job in job_queue if job['priority'] == priority]
+        while pending:
+            oldest = pending[0]
+            if now - oldest['enqueued_at'] >= max_wait:
+                job = oldest
+            else:
+                job = next((job for job in pending if job['model'] in warm), oldest)
+            pending.remove(job)
+            ordered.append(job)
+            # Tras este trabajo su modelo quedará cargado para los siguientes
+            warm.add(job['model'])
+    return ordered
+
+def estimate_job_seconds(job):
+    """Duración estimada de un trabajo según la media de segundos por imagen de su modelo"""
+    seconds_per_image = model_seconds_per_image.get(job['model'], get_scheduler_config()['default_seconds_per_image'])
+    return job['images'] * seconds_per_image
+
+def update_queue_estimates():
+    """Actualizar posición en cola e inicio estimado de las tareas en espera (llamar con job_scheduler_condition)"""
+    config = get_scheduler_config()
+    now = time.time()
+    
+    # Tiempo restante de cada worker: los trabajos en curso ocupan su worker hasta su fin estimado
+    remaining = {job['id']: max(0.0, job['started_at'] + estimate_job_seconds(job) - now) for job in running_jobs.values()}
+    batch_running = [remaining[job['id']] for job in running_jobs.values() if job['priority'] == JOB_PRIORITY_BATCH]
+    batch_slots = batch_running + [0.0] * max(0, config['workers'] - config['interactive_workers'] - len(batch_running))
+    all_slots = list(remaining.values()) + [0.0] * max(0, config['workers'] - len(remaining))
+    heapq.heapify(batch_slots)
+    heapq.heapify(all_slots)
+    
+    for position, job in enumerate(order_queued_jobs(now), 1):
+        slots = all_slots if job['priority'] == JOB_PRIORITY_INTERACTIVE else batch_slots
+        start = heapq.heappop(slots)
+        heapq.heappush(slots, start + estimate_job_seconds(job))
+        if job['task_id'] and job['task_id'] in progress_data:
+            task = progress_data[job['task_id']]
+            task['queue_position'] = position
+            task['estimated_start'] = round(now + start, 1)
+            task['estimated_wait_seconds'] = round(start, 1)
+            task['message'] = f"En cola (posición {position})"
+    
+    for job in job_queue:
+        if job['task_id']:
+            notify_task_update(job['task_id'])
+
+def take_next_job():
+    """Sacar de la cola el siguiente trabajo ejecutable (llamar con job_scheduler_condition)"""
+    config = get_scheduler_config()
+    batch_running = sum(1 for job in running_jobs.values() if job['priority'] == JOB_PRIORITY_BATCH)
+    batch_capacity = config['workers'] - config['interactive_workers']
+    for job in order_queued_jobs():
+        if job['priority'] == JOB_PRIORITY_BATCH and batch_running >= batch_capacity:
+            continue
+        job_queue.remove(job)
+        return job
+    return None
+
+def job_worker_loop():
+    """Worker del planificador: ejecuta trabajos de la cola uno a uno"""
+    while True:
+        with job_scheduler_condition:
+            job = take_next_job()
+            while job is None:
+                job_scheduler_condition.wait()
+                job = take_next_job()
+            
+            # Un trabajo cancelado mientras esperaba se descarta
+            if not job['future'].set_running_or_notify_cancel():
+                update_queue_estimates()
+                continue
+            job['started_at'] = time.time()
+            running_jobs[job['id']] = job
+            update_queue_estimates()
+        
+        try:
+            job['future'].set_result(job['fn'](*job['args']))
+        except Exception as e:
+            job['future'].set_exception(e)
+        finally:
+            with job_scheduler_condition:
+                running_jobs.pop(job['id'], None)
+                # Media móvil de segundos por imagen para las estimaciones de la cola
+                seconds_per_image = (time.time() - job['started_at']) / job['images']
+                previous = model_seconds_per_image.get(job['model'])
+                model_seconds_per_image[job['model']] = seconds_per_image if previous is None else 0.7 * previous + 0.3 * seconds_per_image
+                update_queue_estimates()
+                job_scheduler_condition.notify_all()
+
+def get_scheduler_status():
+    """Estado del planificador para /api/models/status"""
+    with job_scheduler_condition:
+        return {
+            **get_scheduler_config(),
+            'queued': [{'model': job['model'], 'images': job['images'],
+                        'lane': 'interactive' if job['priority'] == JOB_PRIORITY_INTERACTIVE else 'batch'}
+                       for job in order_queued_jobs()],
+            'running': [{'model': job['model'], 'images': job['images'],
+                         'lane': 'interactive' if job['priority'] == JOB_PRIORITY_INTERACTIVE else 'batch',
+                         'elapsed_seconds': round(time.time() - job['started_at'], 1)}
+                        for job in running_jobs.values()],
+            'seconds_per_image': {name: round(value, 2) for name, value in model_seconds_per_image.items()}
+        }
 
 @app.errorhandler(413)
 def too_large(e):
@@ -1327,6 +3402,7 @@ def save_config():
         # Recargar configuración global
         global CONFIG
         CONFIG = new_config
+        compile_caption_cleaning()
         
         # Actualizar variables de entorno
         if new_config.get('api_keys', {}).get('openrouter'):
@@ -1339,115 +3415,333 @@ def save_config():
 
 @app.route('/api/image/<file_id>')
 def get_image(file_id):
-    """Obtener imagen por ID"""
+    """Obtener imagen por ID (?match=prefix para buscar por el comienzo del ID o nombre)"""
     try:
-        # Buscar archivo en uploads
-        upload_folder = app.config['UPLOAD_FOLDER']
-        
-        # Primero intentar encontrar el archivo exacto
-        file_path = os.path.join(upload_folder, file_id)
-        if os.path.exists(file_path):
-            return send_file(file_path)
-        
-        # Si no se encuentra, buscar por nombre parcial
-        for filename in os.listdir(upload_folder):
-            if file_id in filename or filename in file_id:
-                file_path = os.path.join(upload_folder, filename)
-                if os.path.exists(file_path):
-                    return send_file(file_path)
-        
-        return jsonify({'error': 'Imagen no encontrada'}), 404
+        # Búsqueda exacta O(1) en el índice (ID de contenido o nombre de subida antigua)
+        file_path = lookup_upload(file_id)
+        
+        # Búsqueda parcial explícita por prefijo
+        if not file_path and request.args.get('match') == 'prefix' and file_id:
+            matches = find_uploads_by_prefix(file_id, limit=11)
+            if len(matches) > 1:
+                return jsonify({'error': 'Prefijo ambiguo', 'matches': matches[:10]}), 409
+            if matches:
+                file_id = matches[0]
+                file_path = lookup_upload(file_id)
+        
+        if not file_path:
+            return jsonify({'error': 'Imagen no encontrada'}), 404
+        
+        if not os.path.isfile(file_path):
+            # Borrado fuera de la aplicación: corregir el índice
+            unindex_upload(file_id)
+            return jsonify({'error': 'Imagen no encontrada'}), 404
+        
+        return send_file(file_path)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/download-zip', methods=['POST'])
-def download_zip():
-    """Descargar resultados como ZIP con imágenes redimensionadas"""
+@app.route('/api/image/<file_id>', methods=['DELETE'])
+def delete_image(file_id):
+    """Eliminar una imagen subida por ID
+
+    El ID es el hash del contenido: todas las subidas del mismo archivo comparten el objeto,
+    por lo que eliminarlo elimina también sus duplicados. Devuelve 409 mientras un trabajo
+    en cola o en ejecución use la imagen.
+    """
     try:
-        data = request.get_json()
-        results = data.get('results', [])
-        width = data.get('width', 1024)
-        height = data.get('height', 1024)
+        file_path = lookup_upload(file_id)
+        if not file_path:
+            return jsonify({'success': False, 'error': 'Imagen no encontrada'}), 404
+        
+        # Con el lock del planificador no se puede encolar un trabajo entre la comprobación y el borrado
+        with job_scheduler_condition:
+            if is_upload_in_use(file_id):
+                return jsonify({'success': False, 'error': 'La imagen está en uso por una tarea en curso'}), 409
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+            unindex_upload(file_id)
+        return jsonify({'success': True, 'message': f'Imagen {file_id} eliminada (y sus subidas duplicadas)'})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Extensiones de formatos ya comprimidos: se guardan en el ZIP sin volver a aplicar DEFLATE
+COMPRESSED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+ZIP_STREAM_CHUNK_SIZE = 1024 * 1024
+
+class ZipStreamBuffer:
+    """Destino de escritura para zipfile que acumula bytes hasta que el generador los entrega"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        """Obtener y vaciar los bytes pendientes"""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+# Margen de reducción previa: se decodifica a >= 2x el tamaño final antes del LANCZOS
+# (umbral a partir del cual Pillow considera el resultado indistinguible del remuestreo completo)
+EXPORT_REDUCING_GAP = 2.0
+export_executor = None
+export_executor_lock = threading.Lock()
+
+def get_export_workers():
+    """Obtener el número de hilos para redimensionar en la exportación (0 = núcleos disponibles)"""
+    workers = int(CONFIG.get("settings", {}).get("export_workers", 0))
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+def get_export_executor():
+    """Obtener (creándolo una sola vez) el pool compartido de redimensionado"""
+    global export_executor
+    
+    # Pillow libera el GIL al decodificar, remuestrear y codificar JPEG,
+    # así que un pool de hilos escala con los núcleos sin reimportar torch en otros procesos
+    with export_executor_lock:
+        if export_executor is None:
+            export_executor = ThreadPoolExecutor(max_workers=get_export_workers(), thread_name_prefix='zip-resize')
+        return export_executor
+
+def iter_export_images(paths, width, height):
+    """Redimensionar imágenes en paralelo, devolviendo (bytes, error) en el orden original con una ventana acotada"""
+    executor = get_export_executor()
+    window = deque()
+    max_in_flight = get_export_workers() * 2  # Limita cuántas imágenes redimensionadas esperan en memoria
+    
+    for path in paths:
+        window.append(executor.submit(resize_image_for_export, path, width, height) if path else None)
+        if len(window) >= max_in_flight:
+            yield export_future_result(window.popleft())
+    while window:
+        yield export_future_result(window.popleft())
+
+def export_future_result(future):
+    """Resultado de un redimensionado como (bytes, error); (None, None) si no había imagen"""
+    if future is None:
+        return None, None
+    try:
+        return future.result(), None
+    except Exception as e:
+        return None, e
+
+# Caché en disco de imágenes derivadas (hash del contenido, tamaño destino, calidad) con expulsión LRU
+DERIVED_CACHE_VERSION = 1  # Incrementar si cambia el pipeline de redimensionado
+derived_cache_index = None  # OrderedDict ruta -> bytes, del menos al más recientemente usado
+derived_cache_bytes = 0
+derived_cache_lock = threading.Lock()
+
+def get_derived_cache_config():
+    """Obtener configuración de la caché de imágenes derivadas desde config.json"""
+    cache_config = CONFIG.get("derived_cache", {})
+    return {
+        'enabled': bool(cache_config.get("enabled", True)),
+        'path': cache_config.get("path", "cache/derived"),
+        'max_size_mb': float(cache_config.get("max_size_mb", 2048))
+    }
+
+def load_derived_cache_index():
+    """Reconstruir el índice LRU desde disco (la fecha de modificación guarda el último acceso); llamar con el lock"""
+    global derived_cache_index, derived_cache_bytes
+    
+    if derived_cache_index is not None:
+        return derived_cache_index
+    
+    entries = []
+    for root, _, filenames in os.walk(get_derived_cache_config()['path']):
+        for filename in filenames:
+            if filename.endswith('.jpg'):
+                stat = os.stat(os.path.join(root, filename))
+                entries.append((stat.st_mtime, os.path.join(root, filename), stat.st_size))
+    
+    derived_cache_index = OrderedDict((path, size) for _, path, size in sorted(entries))
+    derived_cache_bytes = sum(derived_cache_index.values())
+    return derived_cache_index
+
+def derived_cache_path(content_hash, width, height, quality):
+    """Ruta de la imagen derivada para (hash, tamaño destino, calidad)"""
+    name = f"{content_hash}_{width}x{height}_q{quality}_v{DERIVED_CACHE_VERSION}.jpg"
+    return os.path.join(get_derived_cache_config()['path'], content_hash[:2], name)
+
+def derived_cache_get(cache_path):
+    """Leer una imagen derivada de la caché; None si no existe"""
+    with derived_cache_lock:
+        index = load_derived_cache_index()
+        if cache_path not in index:
+            return None
+        index.move_to_end(cache_path)
+    
+    try:
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        os.utime(cache_path)  # Conservar el orden LRU entre reinicios
+        return data
+    except FileNotFoundError:
+        with derived_cache_lock:
+            derived_cache_forget(cache_path)
+        return None
+
+def derived_cache_forget(cache_path):
+    """Quitar una entrada del índice; llamar con el lock"""
+    global derived_cache_bytes
+    
+    size = derived_cache_index.pop(cache_path, None)
+    if size is not None:
+        derived_cache_bytes -= size
+
+def derived_cache_put(cache_path, data):
+    """Guardar una imagen derivada y expulsar las menos usadas si se supera max_size_mb"""
+    global derived_cache_bytes
+    
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = f"{cache_path}.{threading.get_ident()}.part"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, cache_path)
+    
+    max_bytes = get_derived_cache_config()['max_size_mb'] * 1024**2
+    with derived_cache_lock:
+        index = load_derived_cache_index()
+        derived_cache_forget(cache_path)
+        index[cache_path] = len(data)
+        derived_cache_bytes += len(data)
+        
+        while derived_cache_bytes > max_bytes and len(index) > 1:
+            oldest_path = next(iter(index))
+            derived_cache_forget(oldest_path)
+            try:
+                os.remove(oldest_path)
+            except FileNotFoundError:
+                pass
+
+def resize_image_for_export(original_path, width, height):
+    """Redimensionar una imagen para el ZIP manteniendo aspect ratio; devuelve los bytes JPEG"""
+    quality = CONFIG["settings"]["download_image_quality"]
+    cache_path = None
+    if get_derived_cache_config()['enabled']:
+        # Exportaciones repetidas con el mismo tamaño: copiar desde la caché sin decodificar ni remuestrear
+        cache_path = derived_cache_path(compute_file_hash(original_path), width, height, quality)
+        cached = derived_cache_get(cache_path)
+        if cached is not None:
+            return cached
+    
+    image_bytes = render_export_image(original_path, width, height, quality)
+    if cache_path is not None:
+        derived_cache_put(cache_path, image_bytes)
+    return image_bytes
+
+def render_export_image(original_path, width, height, quality):
+    """Decodificar, redimensionar y codificar una imagen para el ZIP"""
+    with Image.open(original_path) as img:
+        # Calcular nuevas dimensiones manteniendo aspect ratio (desde la cabecera, sin decodificar)
+        original_width, original_height = img.size
         
-        if not results:
-            return jsonify({'error': 'No hay resultados para descargar'}), 400
+        # Calcular el factor de escala para mantener aspect ratio
+        scale_w = width / original_width
+        scale_h = height / original_height
+        scale = min(scale_w, scale_h)  # Usar el menor para que quepa en ambas dimensiones
         
-        print(f"Descargando ZIP con resolución: {width}x{height}")
+        # Calcular nuevas dimensiones
+        new_width = int(original_width * scale)
+        new_height = int(original_height * scale)
         
-        # Crear archivo ZIP temporal
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            
-            # Crear carpeta para las imágenes
-            images_folder = 'images/'
+        print(f"Redimensionando {os.path.basename(original_path)}: {original_width}x{original_height} -> {new_width}x{new_height}")
+        
+        # JPEG: decodificar directamente a escala reducida (1/2, 1/4, 1/8) sin bajar del margen de calidad
+        img.draft(None, (int(new_width * EXPORT_REDUCING_GAP), int(new_height * EXPORT_REDUCING_GAP)))
+        
+        # Convertir a RGB si es necesario
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        # Redimensionar con máxima calidad; reducing_gap aplica reduce() entero antes del LANCZOS en otros formatos
+        img_resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=EXPORT_REDUCING_GAP)
+        
+        # Guardar en buffer con máxima calidad
+        img_buffer = BytesIO()
+        img_resized.save(img_buffer, format='JPEG', quality=quality, optimize=True)
+        return img_buffer.getvalue()
+
+def zip_entry_info(arcname, compress_type):
+    """Crear la cabecera de una entrada del ZIP con la fecha actual"""
+    info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+    info.compress_type = compress_type
+    return info
+
+def unique_archive_name(filename, used_names):
+    """Evitar nombres repetidos en el ZIP (dos archivos distintos subidos con el mismo nombre)"""
+    stem, extension = os.path.splitext(filename)
+    candidate = filename
+    counter = 2
+    while candidate.lower() in used_names:
+        candidate = f"{stem}_{counter}{extension}"
+        counter += 1
+    used_names.add(candidate.lower())
+    return candidate
+
+def iter_zip_export(results, width, height):
+    """Generar el ZIP de exportación por trozos, entregando los bytes a medida que se escribe cada entrada"""
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        
+        # Crear carpeta para las imágenes
+        images_folder = 'images/'
+        
+        # Buscar las imágenes originales y redimensionarlas en paralelo con la resolución seleccionada
+        original_paths = [resolve_upload_path(result.get('file_id') or result.get('filename', '')) for result in results]
+        original_paths = [path if os.path.isfile(path) else None for path in original_paths]
+        resized_images = iter_export_images(original_paths, width, height)
+        
+        # Agregar cada resultado
+        used_names = set()
+        for result, original_path, (image_bytes, resize_error) in zip(results, original_paths, resized_images):
+            filename = unique_archive_name(result.get('filename', ''), used_names)
+            caption = result.get('caption', '')
             
-            # Agregar cada resultado
-            for result in results:
-                filename = result.get('filename', '')
-                caption = result.get('caption', '')
-                model_used = result.get('model_used', 'unknown')
+            if original_path is not None:
+                if resize_error is None:
+                    # JPEG ya está comprimido: guardarlo sin DEFLATE
+                    zip_file.writestr(zip_entry_info(f"{images_folder}{filename}", zipfile.ZIP_STORED), image_bytes)
+                    
+                else:
+                    print(f"Error procesando imagen {filename}: {resize_error}")
+                    # Si falla el redimensionado, copiar original por trozos
+                    extension = os.path.splitext(filename)[1].lower()
+                    compress_type = zipfile.ZIP_STORED if extension in COMPRESSED_IMAGE_EXTENSIONS else zipfile.ZIP_DEFLATED
+                    with open(original_path, 'rb') as src, zip_file.open(zip_entry_info(f"{images_folder}{filename}", compress_type), 'w', force_zip64=True) as dest:
+                        for chunk in iter(lambda: src.read(ZIP_STREAM_CHUNK_SIZE), b''):
+                            dest.write(chunk)
+                            yield buffer.drain()
                 
-                # Buscar la imagen original
-                original_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                
-                if os.path.exists(original_path):
-                    # Redimensionar imagen para el ZIP con resolución seleccionada
-                    try:
-                        with Image.open(original_path) as img:
-                            # Convertir a RGB si es necesario
-                            if img.mode != 'RGB':
-                                img = img.convert('RGB')
-                            
-                            # Calcular nuevas dimensiones manteniendo aspect ratio
-                            original_width, original_height = img.size
-                            
-                            # Calcular el factor de escala para mantener aspect ratio
-                            scale_w = width / original_width
-                            scale_h = height / original_height
-                            scale = min(scale_w, scale_h)  # Usar el menor para que quepa en ambas dimensiones
-                            
-                            # Calcular nuevas dimensiones
-                            new_width = int(original_width * scale)
-                            new_height = int(original_height * scale)
-                            
-                            print(f"Redimensionando {filename}: {original_width}x{original_height} -> {new_width}x{new_height}")
-                            
-                            # Redimensionar con máxima calidad
-                            img_resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                            
-                            # Guardar en buffer con máxima calidad
-                            img_buffer = BytesIO()
-                            img_resized.save(img_buffer, format='JPEG', quality=CONFIG["settings"]["download_image_quality"], optimize=True)
-                            img_buffer.seek(0)
-                            
-                            # Agregar imagen redimensionada a la carpeta
-                            zip_file.writestr(f"{images_folder}{filename}", img_buffer.getvalue())
-                            
-                    except Exception as e:
-                        print(f"Error procesando imagen {filename}: {e}")
-                        # Si falla el redimensionado, copiar original
-                        with open(original_path, 'rb') as f:
-                            zip_file.writestr(f"{images_folder}{filename}", f.read())
-                
-                # Agregar archivo de texto con caption (solo el caption)
-                caption_filename = f"{images_folder}{os.path.splitext(filename)[0]}.txt"
-                zip_file.writestr(caption_filename, caption)
-            
-            # Crear JSON con toda la información
-            json_data = {
-                'metadata': {
-                    'total_images': len(results),
-                    'generated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'models_used': list(set(r.get('model_used', 'unknown') for r in results))
-                },
-                'results': results
-            }
+                yield buffer.drain()
             
-            # Agregar JSON a la raíz del ZIP
-            zip_file.writestr('results.json', json.dumps(json_data, indent=2, ensure_ascii=False))
-            
-            # Agregar README
-            readme_content = f"""# Resultados de Captioning IA
+            # Agregar archivo de texto con caption (solo el caption)
+            caption_filename = f"{images_folder}{os.path.splitext(filename)[0]}.txt"
+            zip_file.writestr(caption_filename, caption)
+            yield buffer.drain()
+        
+        # Crear JSON con toda la información
+        json_data = {
+            'metadata': {
+                'total_images': len(results),
+                'generated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'models_used': list(set(r.get('model_used', 'unknown') for r in results))
+            },
+            'results': results
+        }
+        
+        # Agregar JSON a la raíz del ZIP
+        zip_file.writestr('results.json', json.dumps(json_data, indent=2, ensure_ascii=False))
+        
+        # Agregar README
+        readme_content = f"""# Resultados de Captioning IA
 
 ## Información General
 - Total de imágenes: {len(results)}
@@ -1463,15 +3757,45 @@ Cada imagen tiene su archivo TXT correspondiente que contiene únicamente el cap
 
 Generado por: Herramienta de Captioning IA
 """
-            zip_file.writestr('README.txt', readme_content)
+        zip_file.writestr('README.txt', readme_content)
+        yield buffer.drain()
+    
+    # Directorio central del ZIP, escrito al cerrar el archivo
+    yield buffer.drain()
+
+@app.route('/api/download-zip', methods=['POST'])
+def download_zip():
+    """Descargar resultados como ZIP con imágenes redimensionadas (streaming, memoria acotada)"""
+    try:
+        data = request.get_json()
+        results = data.get('results', [])
+        width = data.get('width', 1024)
+        height = data.get('height', 1024)
         
-        zip_buffer.seek(0)
+        if not results:
+            return jsonify({'error': 'No hay resultados para descargar'}), 400
+        
+        print(f"Descargando ZIP con resolución: {width}x{height}")
         
-        return send_file(
-            zip_buffer,
+        download_name = f'captions_{time.strftime("%Y%m%d_%H%M%S")}.zip'
+        
+        def chunks():
+            # Bytes y duración de la exportación, registrados al terminar (o al cortarse) el streaming
+            start = time.perf_counter()
+            sent = 0
+            try:
+                for chunk in iter_zip_export(results, width, height):
+                    if chunk:
+                        sent += len(chunk)
+                        yield chunk
+            finally:
+                metrics_inc('captioning_zip_export_bytes_total', sent)
+                metrics_observe('captioning_zip_export_seconds', time.perf_counter() - start)
+        
+        return Response(
+            stream_with_context(chunks()),
             mimetype='application/zip',
-            as_attachment=True,
-            download_name=f'captions_{time.strftime("%Y%m%d_%H%M%S")}.zip'
+            headers={'Content-Disposition': f'attachment; filename={download_name}'}
         )
         
     except Exception as e:
@@ -1487,8 +3811,14 @@ def internal_error(e):
 if __name__ == '__main__':
     print("🚀 Iniciando aplicación...")
     initialize_models()
+    rebuild_upload_index()
+    prune_persisted_tasks(force=True)
+    # Con el recargador de debug el script se ejecuta dos veces: precargar solo en el proceso que sirve
+    if not DEBUG_MODE or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        model_preload_state['ready'] = not CONFIG.get("models", {}).get("preload")
+        threading.Thread(target=preload_models, name='model-preload', daemon=True).start()
     print("✅ Sistema de carga dinámica inicializado")
-    print(f"🔧 Dispositivo disponible: {device}")
+    print("🔧 Dispositivo: se detecta al cargar el primer modelo local (torch se importa bajo demanda)")
     print(f"🌐 Aplicación disponible en: http://{CONFIG['server']['host']}:{CONFIG['server']['port']}")
     print(f"📁 Límite de archivos: {CONFIG['limits']['max_files']} imágenes máximo")
     print(f"💾 Límite de tamaño: {CONFIG['limits']['max_file_size_mb']}MB por imagen")
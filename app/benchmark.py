@@ -0,0 +1,553 @@
+"""Micro-benchmarks de la aplicación (ejecutar desde app/: python benchmark.py <nombre> [--json resultados.json])
+
+Funcionan sin GPU ni red: los benchmarks de modelos usan configuraciones diminutas con pesos aleatorios.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+from contextlib import contextmanager, nullcontext, redirect_stdout
+
+# Los mensajes de arranque de app.py van a stderr para que --json - deje en stdout solo el JSON
+with redirect_stdout(sys.stderr):
+    import app as captioning_app
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    """Registrar una función de benchmark por nombre"""
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+def time_per_call(fn, items, repeat=5):
+    """Mejor tiempo por elemento (µs) de varias repeticiones de fn sobre items"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(items)
+        best = min(best, time.perf_counter() - start)
+    return best / max(len(items), 1) * 1e6
+
+def latency_stats(fn, items):
+    """Latencias por elemento (ms): p50, p99 y elementos por segundo de una pasada de fn sobre cada item"""
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        call_start = time.perf_counter()
+        fn(item)
+        latencies.append((time.perf_counter() - call_start) * 1000)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    # Percentil por rango más cercano (sin interpolar, estable con pocas muestras)
+    percentile = lambda q: latencies[min(len(latencies) - 1, max(0, round(q / 100 * len(latencies)) - 1))]
+    return {'p50_ms': percentile(50), 'p99_ms': percentile(99), 'per_sec': len(items) / elapsed if elapsed else 0.0}
+
+@contextmanager
+def override_config(section, **values):
+    """Sustituir temporalmente claves de CONFIG (se restauran al salir)"""
+    original = captioning_app.CONFIG.get(section)
+    captioning_app.CONFIG[section] = {**(original or {}), **values}
+    try:
+        yield
+    finally:
+        if original is None:
+            captioning_app.CONFIG.pop(section, None)
+        else:
+            captioning_app.CONFIG[section] = original
+
+def make_test_images(directory, count, size=(640, 480), seed=0):
+    """Guardar fotos sintéticas (ruido sobre un degradado) y devolver sus nombres"""
+    from PIL import Image
+    rng = random.Random(seed)
+    names = []
+    for index in range(count):
+        gradient = Image.linear_gradient('L').resize(size)
+        image = Image.merge('RGB', (gradient, Image.effect_noise(size, rng.randint(10, 60)), gradient.rotate(90)))
+        name = f'bench_{index:04d}.jpg'
+        image.save(os.path.join(directory, name), quality=90)
+        names.append(name)
+    return names
+
+# ---------------------------------------------------------------------------
+# Consistencia de términos de personas
+# ---------------------------------------------------------------------------
+
+# Casos de referencia (caption, modo, resultado esperado) obtenidos con la implementación original
+CONSISTENCY_GOLDEN = [
+    ('a woman sitting on a bench', 'auto', 'a woman sitting on a bench'),
+    ('A Little Girl and a man  with kids', 'auto', 'a little girl and a little girl with little girl'),
+    ('a young girl and a boy playing', 'auto', 'a young girl and a young girl playing'),
+    ('a teen girl with her friend', 'auto', 'a person with her friend'),
+    ('a man and a woman walking', 'auto', 'a woman and a woman walking'),
+    ('a boy and a man at the beach', 'auto', 'a boy and a boy at the beach'),
+    ('two people and a child', 'auto', 'two person and a person'),
+    ('a lady in a red dress', 'man', 'a man in a red dress'),
+    ('a gentleman with a little boy', 'woman', 'a woman with a woman'),
+    ('a woman with a girl,', 'auto', 'a woman with a girl,'),
+    ('  A   Dog on   the grass ', 'auto', 'a dog on the grass'),
+    ('A Woman In The Park', 'none', 'A Woman In The Park'),
+    ('a teenage boy and a young boy', 'girl', 'a girl and a girl'),
+    ('persons individual kid female male', 'person', 'person person person person person'),
+    ('a little dog and a young cat', 'auto', 'a little dog and a young cat'),
+    ('little little girl girl', 'auto', 'little little girl little girl'),
+    ('', 'auto', ''),
+]
+
+CONSISTENCY_VOCAB = ['a', 'the', 'little', 'young', 'teen', 'girl', 'boy', 'man', 'woman', 'people',
+                     'standing', 'with', 'dog', 'in', 'front', 'of', 'building', 'red', 'dress', 'and']
+
+def legacy_apply_consistency_rules(caption, consistency_mode='auto'):
+    """Implementación original palabra a palabra (línea base del benchmark, sin los print)"""
+    if consistency_mode == 'none':
+        return caption
+    person_terms = {term: term for term in captioning_app.PERSON_TERMS}
+    if consistency_mode in captioning_app.CONSISTENCY_TARGET_TERMS:
+        target_term = consistency_mode
+    else:
+        target_term = legacy_detect_predominant_person_term(caption, person_terms)
+    words = caption.lower().split()
+    normalized_words = []
+    for i, word in enumerate(words):
+        found_replacement = False
+        if i + 2 < len(words) and f"{word} {words[i+1]} {words[i+2]}" in person_terms:
+            normalized_words.append(target_term)
+            words[i+1] = ''
+            words[i+2] = ''
+            found_replacement = True
+        if not found_replacement and i + 1 < len(words) and f"{word} {words[i+1]}" in person_terms:
+            normalized_words.append(target_term)
+            words[i+1] = ''
+            found_replacement = True
+        if not found_replacement and word in person_terms:
+            normalized_words.append(target_term)
+            found_replacement = True
+        if not found_replacement and word != '':
+            normalized_words.append(word)
+    return ' '.join(normalized_words)
+
+def legacy_detect_predominant_person_term(caption, person_terms):
+    """Detección original del término predominante (línea base del benchmark)"""
+    words = caption.lower().split()
+    found = set()
+    for i, word in enumerate(words):
+        if i + 2 < len(words) and f"{word} {words[i+1]} {words[i+2]}" in person_terms:
+            found.add(person_terms[f"{word} {words[i+1]} {words[i+2]}"])
+            words[i+1] = ''
+            words[i+2] = ''
+            continue
+        if i + 1 < len(words) and f"{word} {words[i+1]}" in person_terms:
+            found.add(person_terms[f"{word} {words[i+1]}"])
+            words[i+1] = ''
+            continue
+        if word in person_terms:
+            found.add(person_terms[word])
+    return captioning_app.pick_target_term(found)
+
+@benchmark('consistency')
+def bench_consistency(args):
+    """Normalización de términos de personas: casos de referencia y coste por caption"""
+    for caption, mode, expected in CONSISTENCY_GOLDEN:
+        result = captioning_app.apply_consistency_rules(caption, mode)
+        if result != expected:
+            raise AssertionError(f"{caption!r} ({mode}): esperado {expected!r}, obtenido {result!r}")
+
+    # Equivalencia con la implementación original sobre captions aleatorios
+    rng = random.Random(args.seed)
+    captions = [' '.join(rng.choice(CONSISTENCY_VOCAB) for _ in range(rng.randint(5, 20))) for _ in range(args.items)]
+    for mode in ('auto', 'woman'):
+        if captioning_app.apply_consistency_rules_batch(captions, mode) != [legacy_apply_consistency_rules(c, mode) for c in captions]:
+            raise AssertionError(f"Resultados distintos de la implementación original en modo {mode}")
+
+    return {
+        'golden_cases': len(CONSISTENCY_GOLDEN),
+        'captions': len(captions),
+        'legacy_us_per_caption': time_per_call(lambda items: [legacy_apply_consistency_rules(c) for c in items], captions, args.repeat),
+        'compiled_us_per_caption': time_per_call(captioning_app.apply_consistency_rules_batch, captions, args.repeat),
+    }
+
+# ---------------------------------------------------------------------------
+# Limpieza de captions de BLIP-2
+# ---------------------------------------------------------------------------
+
+CLEANING_VOCAB = ['a', 'woman', 'the', 'the', 'in', 'paris', 'photo', 'avec', 'standing', 'street', 'une', 'femme',
+                  '$44', '-', '$45', '1234', 'tool', 'her', 'hand', 'on', 'dog', 'dog', 'leggings', 'red', 'dress']
+
+def legacy_clean_blip2_caption(caption):
+    """Implementación original con un re.sub por término (línea base del benchmark)"""
+    import re
+    caption = re.sub(r'\$\d+(?:\.\d+)?(?:\s*-\s*\$\d+(?:\.\d+)?)?', '', caption)
+    for name in ('cities_countries', 'french_phrases', 'brands_products'):
+        for term in captioning_app.CAPTION_CLEANING_DEFAULTS[name]:
+            caption = re.sub(rf'\b{re.escape(term)}\b', '', caption, flags=re.IGNORECASE)
+    caption = re.sub(r'\b\d{3,}\b', '', caption)
+    for term in captioning_app.CAPTION_CLEANING_DEFAULTS['hallucinated_objects']:
+        caption = re.sub(rf'\b{term}\b', '', caption, flags=re.IGNORECASE)
+    caption = re.sub(r'\b(\w+)\s+\1\s+\1\b', r'\1', caption)
+    caption = re.sub(r'\b(\w+)\s+\1\b', r'\1', caption)
+    caption = re.sub(r'\b(her right hand|her left hand|her hand)\s+(on|in|with)\s+(her right hand|her left hand|her hand)\b', 'her hand', caption, flags=re.IGNORECASE)
+    caption = re.sub(r'\b(the|a|an|and|in|on|at|to|of|with|for)\s+\1\b', r'\1', caption, flags=re.IGNORECASE)
+    caption = re.sub(r'\s+', ' ', caption)
+    caption = re.sub(r'[^\w\s.,!?-]', '', caption)
+    return caption.strip()
+
+@benchmark('cleaning')
+def bench_cleaning(args):
+    """Limpieza de captions de BLIP-2: coste por caption antes y después de compilar las listas"""
+    rng = random.Random(args.seed)
+    captions = [' '.join(rng.choice(CLEANING_VOCAB) for _ in range(rng.randint(10, 30))) for _ in range(args.items)]
+    changed = sum(captioning_app.clean_blip2_caption(c) != legacy_clean_blip2_caption(c) for c in captions)
+    blip_captions = [' '.join(rng.choice(CONSISTENCY_VOCAB) for _ in range(rng.randint(10, 30))) for _ in range(args.items)]
+
+    return {
+        'captions': len(captions),
+        # Solo difieren las frases que antes quedaban a medias ('avec les' -> 'les')
+        'different_outputs': changed,
+        'legacy_us_per_caption': time_per_call(lambda items: [legacy_clean_blip2_caption(c) for c in items], captions, args.repeat),
+        'compiled_us_per_caption': time_per_call(captioning_app.clean_blip2_captions, captions, args.repeat),
+        'blip_us_per_caption': time_per_call(captioning_app.clean_blip_captions, blip_captions, args.repeat),
+    }
+
+# ---------------------------------------------------------------------------
+# Precisión de los modelos (fp32 / bf16 / int8 en CPU, fp16 / bf16 / fp32 en GPU)
+# ---------------------------------------------------------------------------
+
+@benchmark('precision')
+def bench_precision(args):
+    """Latencia y memoria de BLIP por modo de precisión (arquitectura base con pesos aleatorios, sin descargas)"""
+    import copy
+    import torch
+    from transformers import BlipConfig, BlipForConditionalGeneration
+
+    torch.manual_seed(args.seed)
+    base_model = BlipForConditionalGeneration(BlipConfig()).eval()
+    image_size = base_model.config.vision_config.image_size
+    device = captioning_app.get_device()
+    images = list(torch.rand(4, 3, image_size, image_size, device=device))
+
+    results = {'device': device.type, 'images': len(images)}
+    for precision in captioning_app.DEVICE_PRECISIONS[device.type if device.type in captioning_app.DEVICE_PRECISIONS else 'cpu']:
+        model = copy.deepcopy(base_model).to(device, getattr(torch, captioning_app.PRECISION_DTYPES[precision]))
+        model = captioning_app.apply_model_precision(model, precision)
+
+        def caption(items, model=model):
+            # Longitud fija (min_length = max_length) para que todos los modos decodifiquen los mismos tokens
+            with torch.no_grad():
+                model.generate(pixel_values=torch.stack(items), max_length=20, min_length=20)
+
+        results[f'{precision}_weights_mb'] = captioning_app.estimate_model_size_mb(model)
+        results[f'{precision}_ms_per_image'] = time_per_call(caption, images, args.repeat) / 1000
+        del model
+    return results
+
+# ---------------------------------------------------------------------------
+# Decodificación de imágenes a resolución reducida para captioning
+# ---------------------------------------------------------------------------
+
+def read_proc_status_kb(field):
+    """Valor (kB) de un campo de /proc/self/status; None fuera de Linux"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+DECODE_LOADERS = ('full', 'reduced')
+
+def load_image_with(loader, path):
+    """Cargar una imagen a resolución completa (implementación original) o reducida para BLIP"""
+    from PIL import Image
+    if loader == 'full':
+        return Image.open(path).convert('RGB')
+    return captioning_app.load_caption_image(path, 'blip')
+
+def measure_decode_peak(loader, path, results):
+    """Pico de memoria residente (MB) de una carga, en un proceso nuevo para no heredar memoria ya reservada"""
+    baseline = read_proc_status_kb('VmRSS')
+    load_image_with(loader, path)
+    peak = read_proc_status_kb('VmHWM')
+    results.put((peak - baseline) / 1024 if peak is not None and baseline is not None else None)
+
+@benchmark('decode')
+def bench_decode(args):
+    """Decodificación de una foto grande: resolución completa frente a la escala mínima para BLIP"""
+    import tempfile
+    import multiprocessing
+    from PIL import Image
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Foto sintética de 24 MP: degradados (zonas suaves) con algo de ruido (detalle)
+        size = (6000, 4000)
+        photo = Image.merge('RGB', (Image.radial_gradient('L').resize(size), Image.effect_noise(size, 20),
+                                    Image.linear_gradient('L').resize(size)))
+        paths = {'jpeg': os.path.join(temp_dir, 'photo.jpg'), 'png': os.path.join(temp_dir, 'photo.png')}
+        photo.save(paths['jpeg'], quality=90)
+        photo.save(paths['png'])
+        del photo
+
+        for image_format, path in paths.items():
+            for loader in DECODE_LOADERS:
+                results[f'{image_format}_{loader}_size'] = 'x'.join(map(str, load_image_with(loader, path).size))
+                results[f'{image_format}_{loader}_ms'] = time_per_call(lambda items: [load_image_with(loader, item) for item in items], [path], args.repeat) / 1000
+                queue = context.Queue()
+                process = context.Process(target=measure_decode_peak, args=(loader, path, queue))
+                process.start()
+                peak = queue.get()
+                process.join()
+                results[f'{image_format}_{loader}_peak_mb'] = peak if peak is not None else 'n/a'
+    return results
+
+# ---------------------------------------------------------------------------
+# Arranque: importación de app.py y primer health check
+# ---------------------------------------------------------------------------
+
+# Se ejecuta en un intérprete nuevo (la importación de este módulo ya cargó app)
+STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/api/health')
+healthy = time.perf_counter()
+heavy = [name for name in ('torch', 'transformers', 'onnxruntime', 'numpy') if name in sys.modules]
+if '--eager' in sys.argv:
+    import torch, transformers, onnxruntime
+    app.get_device()
+eager = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'health_ms': (healthy - imported) * 1000,
+                  'status': response.status_code, 'heavy_modules': heavy, 'ml_import_ms': (eager - healthy) * 1000}))
+"""
+
+@benchmark('startup')
+def bench_startup(args):
+    """Tiempo de arranque en frío: importar app.py y responder al health check sin cargar torch"""
+    def run_probe(*flags):
+        # Mejor de varias ejecuciones (la primera paga la caché de disco)
+        best = None
+        for _ in range(args.repeat):
+            output = subprocess.run([sys.executable, '-c', STARTUP_PROBE, *flags], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            if best is None or result['import_ms'] < best['import_ms']:
+                best = result
+        return best
+
+    lazy = run_probe()
+    eager = run_probe('--eager')
+    return {
+        'import_ms': lazy['import_ms'],
+        'health_ms': lazy['health_ms'],
+        'health_status': lazy['status'],
+        'heavy_modules_at_startup': ', '.join(lazy['heavy_modules']) or 'ninguno',
+        # Coste que antes se pagaba al arrancar y ahora al cargar el primer modelo local
+        'deferred_ml_import_ms': eager['ml_import_ms'],
+    }
+
+# ---------------------------------------------------------------------------
+# Captioning de extremo a extremo con modelos diminutos (CPU, sin red)
+# ---------------------------------------------------------------------------
+
+TINY_VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '[DEC]'] + \
+    'a the woman man girl boy person photo of with in on her hand hair dress red blue sitting standing young little and is at'.split() + \
+    [f'w{index}' for index in range(200)]
+
+def build_tiny_models(work_dir, seed=0):
+    """Construir BLIP y BLIP-2 con la arquitectura real pero capas mínimas y pesos aleatorios (sin descargas)"""
+    import torch
+    from transformers import (BertTokenizer, BlipImageProcessor, BlipConfig, BlipForConditionalGeneration, BlipProcessor,
+                              Blip2Config, Blip2ForConditionalGeneration, Blip2Processor)
+
+    vocab_path = os.path.join(work_dir, 'vocab.txt')
+    with open(vocab_path, 'w') as vocab_file:
+        vocab_file.write('\n'.join(TINY_VOCAB))
+    tokenizer = BertTokenizer(vocab_path, bos_token='[DEC]')
+    layers = dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=2)
+    vision = dict(layers, image_size=64, patch_size=16)
+    image_processor = BlipImageProcessor(size={'height': 64, 'width': 64})
+
+    torch.manual_seed(seed)
+    blip = BlipForConditionalGeneration(BlipConfig(
+        vision_config=vision,
+        text_config=dict(layers, vocab_size=len(tokenizer), encoder_hidden_size=32, bos_token_id=tokenizer.bos_token_id,
+                         pad_token_id=tokenizer.pad_token_id, sep_token_id=tokenizer.sep_token_id),
+    )).eval()
+    blip2 = Blip2ForConditionalGeneration(Blip2Config(
+        vision_config=vision,
+        qformer_config=dict(layers, vocab_size=len(tokenizer), encoder_hidden_size=32),
+        text_config=dict(model_type='t5', vocab_size=len(tokenizer), d_model=32, d_ff=64, num_layers=2, num_heads=2, d_kv=16,
+                         decoder_start_token_id=0, pad_token_id=0, eos_token_id=tokenizer.sep_token_id, bos_token_id=1),
+        num_query_tokens=4, image_token_index=len(tokenizer) - 1,
+    )).eval()
+    return {
+        'blip': (blip, BlipProcessor(image_processor=image_processor, tokenizer=tokenizer)),
+        'blip2': (blip2, Blip2Processor(image_processor=image_processor, tokenizer=tokenizer, num_query_tokens=4)),
+    }
+
+@contextmanager
+def installed_models(tiny_models):
+    """Registrar los modelos diminutos como ya cargados (con un lease permanente) y descargarlos al terminar"""
+    for model_name, (model, processor) in tiny_models.items():
+        captioning_app.models[model_name] = model
+        captioning_app.processors[model_name] = processor
+        captioning_app.model_loading_status.setdefault(model_name, {'available': True})['loaded'] = True
+        with captioning_app.model_registry_lock:
+            captioning_app.model_registry[model_name] = {'loaded': True, 'refs': 1, 'last_used': time.time(),
+                                                          'size_mb': captioning_app.estimate_model_size_mb(model), 'loads': 1}
+    try:
+        yield
+    finally:
+        for model_name in tiny_models:
+            captioning_app.release_model(model_name)
+            captioning_app.evict_model(model_name)
+
+@benchmark('caption')
+def bench_caption(args):
+    """generate_caption con BLIP y BLIP-2 diminutos: imágenes por segundo y latencia p50/p99 (sin caché)"""
+    import tempfile
+
+    images = max(1, min(args.items, 32))
+    results = {'device': captioning_app.get_device().type, 'images': images}
+    with tempfile.TemporaryDirectory() as work_dir:
+        paths = [os.path.join(work_dir, name) for name in make_test_images(work_dir, images, seed=args.seed)]
+        # Generación determinista y sin caché para medir siempre el modelo; PyTorch en fp32 para comparar entre commits
+        with override_config('caption_cache', enabled=False), \
+             override_config('settings', deterministic_generation=True), \
+             override_config('models', backends={'blip': 'pytorch', 'blip2': 'pytorch'}, precision={'blip': 'fp32', 'blip2': 'fp32'}), \
+             installed_models(build_tiny_models(work_dir, args.seed)):
+            for model_name in ('blip', 'blip2'):
+                # Calentamiento: la primera llamada paga la inicialización perezosa de torch
+                captioning_app.generate_caption(paths[0], model_name)
+                stats = latency_stats(lambda path: captioning_app.generate_caption(path, model_name), paths)
+                results[f'{model_name}_images_per_sec'] = stats['per_sec']
+                results[f'{model_name}_p50_ms'] = stats['p50_ms']
+                results[f'{model_name}_p99_ms'] = stats['p99_ms']
+    return results
+
+# ---------------------------------------------------------------------------
+# Exportación ZIP en streaming
+# ---------------------------------------------------------------------------
+
+@benchmark('zip')
+def bench_zip(args):
+    """POST /api/download-zip: imágenes redimensionadas por segundo y MB/s del ZIP generado"""
+    import io
+    import tempfile
+    import zipfile
+
+    images = max(1, min(args.items, 64))
+    original_upload_folder = captioning_app.app.config['UPLOAD_FOLDER']
+    with tempfile.TemporaryDirectory() as upload_dir:
+        payload = {
+            'results': [{'filename': name, 'caption': f'a photo of image {index}'}
+                        for index, name in enumerate(make_test_images(upload_dir, images, size=(1600, 1200), seed=args.seed))],
+            'width': 1024, 'height': 1024,
+        }
+        captioning_app.app.config['UPLOAD_FOLDER'] = upload_dir
+        try:
+            client = captioning_app.app.test_client()
+            # La primera exportación redimensiona; las siguientes sirven las miniaturas desde la caché de derivados
+            timings = []
+            for _ in range(max(2, args.repeat)):
+                start = time.perf_counter()
+                archive = client.post('/api/download-zip', json=payload).get_data()
+                timings.append(time.perf_counter() - start)
+        finally:
+            captioning_app.app.config['UPLOAD_FOLDER'] = original_upload_folder
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as zip_file:
+        entries = len(zip_file.namelist())
+    return {
+        'images': images,
+        'zip_entries': entries,
+        'zip_mb': len(archive) / 1024**2,
+        'cold_images_per_sec': images / timings[0],
+        'cold_mb_per_sec': len(archive) / 1024**2 / timings[0],
+        'cached_images_per_sec': images / min(timings[1:]),
+        'cached_mb_per_sec': len(archive) / 1024**2 / min(timings[1:]),
+    }
+
+# ---------------------------------------------------------------------------
+# Ejecución y salida
+# ---------------------------------------------------------------------------
+
+def reset_peak_rss():
+    """Reiniciar el pico de memoria residente del proceso (VmHWM) para medir cada benchmark por separado"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    """Pico de memoria residente (MB) desde el último reinicio; en otros sistemas, el pico de todo el proceso"""
+    peak_kb = read_proc_status_kb('VmHWM')
+    if peak_kb is not None:
+        return peak_kb / 1024
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS devuelve bytes, Linux kilobytes
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+def run_metadata(args):
+    """Datos del entorno para poder comparar resultados entre commits"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {'items': args.items, 'repeat': args.repeat, 'seed': args.seed},
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks de la aplicación')
+    parser.add_argument('names', nargs='*', help=f"Benchmarks a ejecutar (por defecto todos): {', '.join(BENCHMARKS)}")
+    parser.add_argument('--items', type=int, default=2000, help='Número de elementos por benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='Repeticiones (se toma el mejor tiempo)')
+    parser.add_argument('--seed', type=int, default=0, help='Semilla para los datos aleatorios')
+    parser.add_argument('--json', metavar='RUTA', help="Guardar los resultados en JSON ('-' para la salida estándar)")
+    args = parser.parse_args(argv)
+
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"Benchmark desconocido: {name}")
+
+    # Con --json - la salida estándar queda solo para el JSON (los mensajes de app.py van a stderr)
+    report = {'meta': run_metadata(args), 'results': {}}
+    with redirect_stdout(sys.stderr) if args.json == '-' else nullcontext():
+        for name in names:
+            print(f"⏱️ {name}")
+            reset_peak_rss()
+            results = BENCHMARKS[name](args)
+            results['peak_rss_mb'] = peak_rss_mb()
+            report['results'][name] = results
+            for key, value in results.items():
+                print(f"   {key}: {value:.2f}" if isinstance(value, float) else f"   {key}: {value}")
+
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+    elif args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2, ensure_ascii=False)
+        print(f"💾 Resultados guardados en {args.json}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
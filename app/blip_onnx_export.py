@@ -0,0 +1,123 @@
+"""Exportación de BLIP a ONNX (se importa solo al exportar, junto con torch)"""
+import os
+import json
+
+import torch
+
+def split_attention_heads(states, num_heads):
+    """(batch, tokens, hidden) -> (batch, heads, tokens, head_size)"""
+    batch_size, length, _ = states.shape
+    return states.view(batch_size, length, num_heads, -1).transpose(1, 2)
+
+class BlipVisionExport(torch.nn.Module):
+    """Codificador de visión de BLIP: pixel_values -> image_embeds"""
+    def __init__(self, model):
+        super().__init__()
+        self.vision_model = model.vision_model
+    
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values)[0]
+
+class BlipCrossKVExport(torch.nn.Module):
+    """Proyecciones key/value de la cross-attention, calculadas una sola vez por imagen"""
+    def __init__(self, model):
+        super().__init__()
+        self.layers = model.text_decoder.bert.encoder.layer
+        self.num_heads = model.config.text_config.num_attention_heads
+    
+    def forward(self, image_embeds):
+        cross_kv = []
+        for layer in self.layers:
+            attention = layer.crossattention.self
+            cross_kv.append(split_attention_heads(attention.key(image_embeds), self.num_heads))
+            cross_kv.append(split_attention_heads(attention.value(image_embeds), self.num_heads))
+        return torch.stack(cross_kv)
+
+class BlipDecoderStepExport(torch.nn.Module):
+    """Un paso del decodificador de texto de BLIP con KV cache explícita
+
+    Entradas: el último token de cada secuencia, la KV cache de self-attention (2 * capas, batch, heads,
+    tokens previos, head_size) y la de cross-attention. Salidas: logits del token siguiente y la KV cache ampliada.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.bert = model.text_decoder.bert
+        self.cls = model.text_decoder.cls
+        self.num_heads = model.config.text_config.num_attention_heads
+        self.scale = (model.config.text_config.hidden_size // self.num_heads) ** -0.5
+    
+    def attend(self, query, key, value):
+        probs = torch.softmax(torch.matmul(query, key.transpose(-1, -2)) * self.scale, dim=-1)
+        context = torch.matmul(probs, value)
+        batch_size, num_heads, length, head_size = context.shape
+        return context.transpose(1, 2).reshape(batch_size, length, num_heads * head_size)
+    
+    def forward(self, input_ids, past_kv, cross_kv):
+        embeddings = self.bert.embeddings
+        positions = torch.arange(input_ids.shape[1], device=input_ids.device) + past_kv.shape[3]
+        hidden = embeddings.LayerNorm(embeddings.word_embeddings(input_ids) + embeddings.position_embeddings(positions)[None])
+        
+        present_kv = []
+        for index, layer in enumerate(self.bert.encoder.layer):
+            attention = layer.attention.self
+            key = torch.cat([past_kv[2 * index], split_attention_heads(attention.key(hidden), self.num_heads)], dim=2)
+            value = torch.cat([past_kv[2 * index + 1], split_attention_heads(attention.value(hidden), self.num_heads)], dim=2)
+            present_kv += [key, value]
+            context = self.attend(split_attention_heads(attention.query(hidden), self.num_heads), key, value)
+            hidden = layer.attention.output(context, hidden)
+            
+            cross_attention = layer.crossattention
+            context = self.attend(split_attention_heads(cross_attention.self.query(hidden), self.num_heads),
+                                  cross_kv[2 * index], cross_kv[2 * index + 1])
+            hidden = cross_attention.output(context, hidden)
+            hidden = layer.output(layer.intermediate(hidden), hidden)
+        
+        return self.cls(hidden[:, -1:])[:, 0], torch.stack(present_kv)
+
+def export_blip_onnx(model, export_dir, version):
+    """Exportar BLIP (fp32) a tres grafos ONNX: visión, KV de cross-attention y paso del decodificador"""
+    text_config = model.config.text_config
+    num_layers = text_config.num_hidden_layers
+    num_heads = text_config.num_attention_heads
+    head_size = text_config.hidden_size // num_heads
+    image_size = model.config.vision_config.image_size
+    
+    with torch.no_grad():
+        pixel_values = torch.zeros(1, 3, image_size, image_size)
+        image_embeds = model.vision_model(pixel_values=pixel_values)[0].repeat(2, 1, 1)
+        cross_kv = BlipCrossKVExport(model)(image_embeds)
+        input_ids = torch.full((2, 1), text_config.bos_token_id, dtype=torch.long)
+        past_kv = torch.zeros(2 * num_layers, 2, num_heads, 3, head_size)
+        
+        torch.onnx.export(
+            BlipVisionExport(model), (pixel_values,), os.path.join(export_dir, 'vision.onnx'),
+            input_names=['pixel_values'], output_names=['image_embeds'],
+            dynamic_axes={'pixel_values': {0: 'batch'}, 'image_embeds': {0: 'batch'}},
+            opset_version=17, dynamo=False
+        )
+        torch.onnx.export(
+            BlipCrossKVExport(model), (image_embeds,), os.path.join(export_dir, 'cross_kv.onnx'),
+            input_names=['image_embeds'], output_names=['cross_kv'],
+            dynamic_axes={'image_embeds': {0: 'batch', 1: 'image_tokens'}, 'cross_kv': {1: 'batch', 3: 'image_tokens'}},
+            opset_version=17, dynamo=False
+        )
+        torch.onnx.export(
+            BlipDecoderStepExport(model), (input_ids, past_kv, cross_kv), os.path.join(export_dir, 'decoder.onnx'),
+            input_names=['input_ids', 'past_kv', 'cross_kv'], output_names=['logits', 'present_kv'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'tokens'}, 'past_kv': {1: 'batch', 3: 'past_tokens'},
+                          'cross_kv': {1: 'batch', 3: 'image_tokens'}, 'logits': {0: 'batch'},
+                          'present_kv': {1: 'batch', 3: 'total_tokens'}},
+            opset_version=17, dynamo=False
+        )
+    
+    meta = {
+        'version': version,
+        'num_layers': num_layers,
+        'num_heads': num_heads,
+        'head_size': head_size,
+        'bos_token_id': text_config.bos_token_id,
+        'eos_token_id': text_config.sep_token_id,
+        'pad_token_id': text_config.pad_token_id
+    }
+    with open(os.path.join(export_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
@@ -0,0 +1,31 @@
+"""Aprovisionar snapshots locales de los modelos (ejecutar desde app/: python provision_models.py [blip blip2])
+
+Descarga cada modelo a models.snapshot_dir fijando el commit del repo. Con los snapshots
+aprovisionados la aplicación carga los modelos sin contactar con el hub (models.offline = true
+para prohibirlo del todo).
+"""
+import sys
+import argparse
+
+import app as captioning_app
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Aprovisionar snapshots locales de los modelos')
+    parser.add_argument('names', nargs='*', help=f"Modelos a aprovisionar (por defecto todos): {', '.join(captioning_app.LOCAL_MODELS)}")
+    parser.add_argument('--revision', default=None, help='Rama, tag o commit del repo (por defecto el último commit)')
+    parser.add_argument('--force', action='store_true', help='Volver a descargar aunque el snapshot ya exista')
+    args = parser.parse_args(argv)
+    
+    for name in args.names or captioning_app.LOCAL_MODELS:
+        if name not in captioning_app.LOCAL_MODELS:
+            parser.error(f"Modelo desconocido: {name}")
+        captioning_app.provision_model_snapshot(name, args.revision, args.force)
+        
+        # BLIP con backend ONNX: exportar ya los grafos para que la primera carga no lo haga
+        if name == 'blip' and captioning_app.get_model_backend('blip') == 'onnx':
+            source, local = captioning_app.get_model_source('blip')
+            captioning_app.load_blip_onnx(source, local)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())